@@ -735,13 +735,13 @@ document.addEventListener('DOMContentLoaded', function() {
     window.showDescription = function(filePath) {
         const user = getCurrentUser();
         fetch(`${basePath}/description/${filePath}?user=${encodeURIComponent(user)}`)
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    descriptionText.textContent = data.description;
+            .then(response => response.text().then(text => ({ ok: response.ok, text })))
+            .then(({ ok, text }) => {
+                if (ok) {
+                    descriptionText.textContent = text;
                     descriptionModal.style.display = 'block';
                 } else {
-                    alert(data.message);
+                    alert(text);
                 }
             })
             .catch(error => {
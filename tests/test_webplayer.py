@@ -1,56 +1,773 @@
+import io
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
+from contextlib import closing, suppress
+from unittest.mock import MagicMock, patch
 
-from webplayer import check_disk_space, download_video_and_description, sanitize_filename, validate_and_create_directory
+from webplayer import (
+    app,
+    check_disk_space,
+    collect_media_files,
+    create_default_thumbnails,
+    download_video_and_description,
+    extract_mp3,
+    open_media_index,
+    reconcile_media_index,
+    run_download_process,
+    sanitize_filename,
+    submit_download_job,
+    validate_and_create_directory,
+)
+
+
+def _failed_ytdlp_run(cmd, **kwargs):
+    """Stand-in for yt-dlp that fails like an unsupported URL, without network access"""
+    return subprocess.CompletedProcess(cmd, 1, stdout="", stderr="ERROR: [generic] Unsupported URL")
+
+
+def _failed_ytdlp_download(cmd, cwd, timeout=1800):
+    """Stand-in for the yt-dlp download step that fails without network access"""
+    return 1, ["ERROR: [generic] Unsupported URL"]
+
+
+def _fake_ytdlp_download(cmd, cwd, timeout=1800):
+    """Stand-in for the yt-dlp download step that writes the files yt-dlp would"""
+    stem = cmd[cmd.index("-o") + 1].split(".")[0]
+    with open(os.path.join(cwd, f"{stem}.info.json"), "w", encoding="utf-8") as f:
+        json.dump({"title": "Some: Title", "description": "A description", "thumbnail": None}, f)
+    for suffix in (".mp4", ".jpg", ".en.srt"):
+        with open(os.path.join(cwd, stem + suffix), "wb") as f:
+            f.write(b"x")
+    return 0, []
+
+
+def _fake_ytdlp_download_without_thumbnail(cmd, cwd, timeout=1800):
+    """Stand-in for the yt-dlp download step where thumbnail conversion failed"""
+    stem = cmd[cmd.index("-o") + 1].split(".")[0]
+    with open(os.path.join(cwd, f"{stem}.info.json"), "w", encoding="utf-8") as f:
+        json.dump({"title": "No Thumb", "thumbnail": "https://example.com/thumb.jpg"}, f)
+    with open(os.path.join(cwd, f"{stem}.mp4"), "wb") as f:
+        f.write(b"x")
+    return 0, []
+
+
+def _ram_tmp_root():
+    """
+    Pick a RAM-backed directory for test scratch files.
+
+    SERVE_YOURSELF_TEST_TMPDIR overrides the choice; otherwise /dev/shm is used
+    when writable, falling back to the default temp location.
+    """
+    override = os.environ.get("SERVE_YOURSELF_TEST_TMPDIR")
+    if override:
+        return override
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
 
 
 class TestWebPlayer(unittest.TestCase):
-    def setUp(self):
-        self.temp_dir = tempfile.mkdtemp()
-        self.test_video_path = os.path.join(self.temp_dir, "test_video.mp4")
-        self.test_audio_path = os.path.join(self.temp_dir, "test_audio.mp3")
+    _SANITIZE_CASES = (
+        ("file/with/slashes.txt", "filewithslashes.txt"),
+        ("file*with*asterisks.txt", "filewithasterisks.txt"),
+        ("file?with?question.txt", "filewithquestion.txt"),
+        ("file:with:colons.txt", "filewithcolons.txt"),
+        ('file"with"quotes.txt', "filewithquotes.txt"),
+        ("file<with>brackets.txt", "filewithbrackets.txt"),
+        ("file|with|pipe.txt", "filewithpipe.txt"),
+        ("file#with#hash.txt", "filewithhash.txt"),
+    )
 
-        with open(self.test_video_path, "wb") as f:
-            f.write(b"dummy video content")
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp(dir=_ram_tmp_root())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+
+    def setUp(self):
+        # One shared temp directory per class; each test gets its own file names
+        test_name = self.id().rsplit(".", 1)[-1]
+        self.test_video_path = os.path.join(self.temp_dir, f"{test_name}_video.mp4")
+        self.test_audio_path = os.path.join(self.temp_dir, f"{test_name}_audio.mp3")
 
     def tearDown(self):
-        import shutil
+        for path in (self.test_video_path, self.test_audio_path):
+            with suppress(FileNotFoundError):
+                os.remove(path)
 
-        if os.path.exists(self.test_video_path):
-            os.remove(self.test_video_path)
-        if os.path.exists(self.test_audio_path):
-            os.remove(self.test_audio_path)
-        # Use shutil.rmtree to remove directory and all contents
-        if os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
+    def _materialize_video(self, content=b"dummy video content"):
+        """Write the dummy video file only for tests that need it on disk"""
+        with open(self.test_video_path, "wb") as f:
+            f.write(content)
+        return self.test_video_path
 
     def test_sanitize_filename(self):
         """Test the filename sanitization function"""
-        test_cases = [
-            ("file/with/slashes.txt", "filewithslashes.txt"),
-            ("file*with*asterisks.txt", "filewithasterisks.txt"),
-            ("file?with?question.txt", "filewithquestion.txt"),
-            ("file:with:colons.txt", "filewithcolons.txt"),
-            ('file"with"quotes.txt', "filewithquotes.txt"),
-            ("file<with>brackets.txt", "filewithbrackets.txt"),
-            ("file|with|pipe.txt", "filewithpipe.txt"),
-            ("file#with#hash.txt", "filewithhash.txt"),
-        ]
-
-        for input_name, expected in test_cases:
+        for input_name, expected in self._SANITIZE_CASES:
             with self.subTest(input_name=input_name):
                 result = sanitize_filename(input_name)
                 self.assertEqual(result, expected)
 
-    def test_download_video_and_description_invalid_url(self):
+    def test_sanitize_filename_bulk(self):
+        """Test the translate-based sanitization matches the re.sub reference over many names"""
+        for i in range(10000):
+            name = f'track{i}/part*{i % 7}?:"<>|#.mp3'
+            expected = re.sub(r'[\\/*?:"<>|#]', "", name).strip(" .")
+            self.assertEqual(sanitize_filename(name), expected)
+
+    @patch("webplayer.safe_subprocess_run", side_effect=_failed_ytdlp_run)
+    @patch("webplayer.run_download_process", side_effect=_failed_ytdlp_download)
+    @patch("webplayer.pipe_audio_download", return_value=False)
+    def test_download_video_and_description_invalid_url(self, mock_pipe, mock_download, mock_run):
         """Test video download with an invalid URL"""
+        self._materialize_video()
         result = download_video_and_description("invalid_url")
         self.assertFalse(result["success"])
         self.assertIn("Error", result["message"])
 
-    def test_download_video_and_description_no_url(self):
+    @patch("webplayer.safe_subprocess_run", side_effect=_failed_ytdlp_run)
+    @patch("webplayer.run_download_process", side_effect=_failed_ytdlp_download)
+    @patch("webplayer.pipe_audio_download", return_value=False)
+    def test_download_video_and_description_no_url(self, mock_pipe, mock_download, mock_run):
         """Test video download with no URL"""
+        self._materialize_video()
+        result = download_video_and_description("")
+        self.assertFalse(result["success"])
+
+    @patch("webplayer.run_download_process", side_effect=_fake_ytdlp_download)
+    def test_download_video_and_description_renames_to_title(self, mock_download):
+        """Test downloaded files are renamed from the temporary stem to the sanitized title"""
+        output_path = os.path.join(self.temp_dir, "renames_to_title")
+        result = download_video_and_description("https://example.com/watch?v=abc", output_path=output_path)
+        self.assertTrue(result["success"])
+        files = set(os.listdir(output_path))
+        self.assertIn("Some Title.mp4", files)
+        self.assertIn("Some Title.jpg", files)
+        self.assertIn("Some Title.en.srt", files)
+        self.assertIn("Some Title.txt", files)
+        self.assertIn("Some Title.meta", files)
+        self.assertFalse(any(f.endswith(".info.json") for f in files))
+        with open(os.path.join(output_path, "Some Title.meta"), encoding="utf-8") as f:
+            self.assertTrue(json.load(f)["has_transcript"])
+
+    def test_download_ignores_other_titles_with_same_prefix(self):
+        """Test files of another download whose title starts with this one are not treated as its files"""
+
+        def fake_download(cmd, cwd, timeout=1800):
+            _fake_ytdlp_download(cmd, cwd, timeout)
+            stem = cmd[cmd.index("-o") + 1].split(".")[0]
+            with open(os.path.join(cwd, f"{stem}.mp4"), "wb") as f:
+                f.write(b"x" * 2048)
+            return 0, []
+
+        output_path = os.path.join(self.temp_dir, "same_prefix")
+        os.makedirs(output_path)
+        with open(os.path.join(output_path, "Some Title Remix.mp4"), "wb") as f:
+            f.write(b"x" * 2048)
+
+        with (
+            patch("webplayer.run_download_process", side_effect=fake_download),
+            patch("webplayer.extract_mp3") as mock_extract,
+        ):
+            download_video_and_description("https://example.com/watch?v=prefix", output_path=output_path)
+
+        self.assertEqual(mock_extract.call_args.args[0], os.path.join(output_path, "Some Title.mp4"))
+
+    def test_download_keeps_files_of_other_video_with_same_title(self):
+        """Test a different video with the same sanitized title is saved under a numbered name"""
+        output_path = os.path.join(self.temp_dir, "same_title")
+        os.makedirs(output_path)
+        for name, content in (("Some Title.mp4", b"old video"), ("Some Title.mp3", b"old audio")):
+            with open(os.path.join(output_path, name), "wb") as f:
+                f.write(content)
+
+        with (
+            patch("webplayer.run_download_process", side_effect=_fake_ytdlp_download),
+            patch("webplayer.extract_mp3"),
+        ):
+            result = download_video_and_description("https://example.com/watch?v=other", output_path=output_path)
+
+        self.assertTrue(result["success"])
+        with open(os.path.join(output_path, "Some Title.mp4"), "rb") as f:
+            self.assertEqual(f.read(), b"old video")
+        files = set(os.listdir(output_path))
+        self.assertIn("Some Title (2).mp4", files)
+        self.assertIn("Some Title (2).meta", files)
+        self.assertNotIn("Some Title.meta", files)
+
+    def test_download_skips_url_already_downloaded(self):
+        """Test a URL whose earlier download is still present is not fetched again"""
+        output_path = os.path.join(self.temp_dir, "already_downloaded")
+        url = "https://example.com/watch?v=again"
+        with patch("webplayer.run_download_process", side_effect=_fake_ytdlp_download) as mock_download:
+            download_video_and_description(url, output_path=output_path)
+            result = download_video_and_description(url, output_path=output_path)
+
+        mock_download.assert_called_once()
+        self.assertEqual(result, {"success": True, "message": "Already downloaded: Some: Title"})
+        self.assertNotIn("Some Title (2).mp4", os.listdir(output_path))
+
+    def test_download_reads_latest_printed_info(self):
+        """Test the download writes only selected info fields and reads the last line yt-dlp appended"""
+
+        def fake_download(cmd, cwd, timeout=1800):
+            stem = cmd[cmd.index("-o") + 1].split(".")[0]
+            self.assertEqual(cmd[cmd.index("--print-to-file") + 2], f"{stem}.info.json")
+            with open(os.path.join(cwd, f"{stem}.info.json"), "w", encoding="utf-8") as f:
+                f.write('{"title": "Stale"}\n{"title": "Fresh", "description": "Latest"}\n')
+            with open(os.path.join(cwd, f"{stem}.mp4"), "wb") as f:
+                f.write(b"x")
+            return 0, []
+
+        output_path = os.path.join(self.temp_dir, "printed_info")
+        with patch("webplayer.run_download_process", side_effect=fake_download):
+            result = download_video_and_description("https://example.com/watch?v=info", output_path=output_path)
+
+        self.assertTrue(result["success"])
+        self.assertIn("Fresh.mp4", os.listdir(output_path))
+        with open(os.path.join(output_path, "Fresh.txt"), encoding="utf-8") as f:
+            self.assertEqual(f.read(), "Latest")
+
+    @patch("webplayer.PROGRESS_EMIT_INTERVAL", 0)
+    @patch("webplayer.socketio.emit")
+    def test_run_download_process_reads_both_pipes(self, mock_emit):
+        """Test progress on stdout (including \\r redraws) and errors on stderr are both collected"""
+        script = (
+            "import sys;"
+            "sys.stdout.write('[download] Destination: 100% Pure.mp4\\n');"
+            "sys.stdout.write('[download]  10.0% of 1MiB\\r[download]  55.5% of 1MiB\\n');"
+            "sys.stderr.write('ERROR: something broke\\n')"
+        )
+        returncode, stderr_output = run_download_process([sys.executable, "-c", script], self.temp_dir)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stderr_output, ["ERROR: something broke"])
+        progress = [c.args[1]["progress"] for c in mock_emit.call_args_list]
+        self.assertEqual(progress, [10.0, 55.5])
+
+    def test_run_download_process_keeps_stderr_tail(self):
+        """Test a chatty stderr neither blocks the process nor grows the returned error lines unbounded"""
+        script = "import sys; sys.stderr.write(''.join(f'WARNING: line {i} ' + 'x' * 1000 + '\\n' for i in range(500)))"
+        returncode, stderr_output = run_download_process([sys.executable, "-c", script], self.temp_dir, timeout=30)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(stderr_output), 50)
+        self.assertTrue(stderr_output[-1].startswith("WARNING: line 499 "))
+
+    def test_list_media(self):
+        """Test media listing picks up thumbnails and download dates from sidecar files"""
+        user_dir = os.path.join(self.temp_dir, "listuser")
+        os.makedirs(os.path.join(user_dir, "album"))
+        for name in (
+            "song.mp3",
+            "song.png",
+            "clip.mp4",
+            "notes.txt",
+            "album/track.ogg",
+            "tune.mp3",
+            "tune.gif",
+            "tune.jpg",
+        ):
+            with open(os.path.join(user_dir, name), "wb") as f:
+                f.write(b"x")
+        with open(os.path.join(user_dir, "song.meta"), "w", encoding="utf-8") as f:
+            json.dump({"download_date": 42.0}, f)
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            response = app.test_client().get("/media?user=ListUser&sort=name&order=asc")
+
+        media = {m["path"]: m for m in response.get_json()}
+        self.assertEqual(sorted(media), ["album/track.ogg", "clip.mp4", "song.mp3", "tune.mp3"])
+        self.assertEqual(media["song.mp3"]["thumbnail"], "song.png")
+        self.assertEqual(media["tune.mp3"]["thumbnail"], "tune.jpg")
+        self.assertEqual(media["song.mp3"]["date_downloaded"], 42.0)
+        self.assertEqual(media["clip.mp4"]["thumbnail"], "default_video_thumbnail.jpg")
+        self.assertEqual(media["album/track.ogg"]["type"], "audio")
+
+    def test_list_media_reuses_scan_until_directory_changes(self):
+        """Test /media only rescans the user directory after its mtime changes"""
+        user_dir = os.path.join(self.temp_dir, "cacheuser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "one.mp3"), "wb") as f:
+            f.write(b"x")
+        os.utime(user_dir, (1_000_000, 1_000_000))
+
+        client = app.test_client()
+        with (
+            patch("webplayer.MEDIA_FOLDER", self.temp_dir),
+            patch("webplayer.collect_media_files", wraps=collect_media_files) as mock_collect,
+        ):
+            first_response = client.get("/media?user=cacheuser&sort=name")
+            first = first_response.get_json()
+            second = client.get("/media?user=cacheuser&sort=size").get_json()
+            self.assertEqual(mock_collect.call_count, 1)
+            self.assertEqual(first, second)
+            etag = {"If-None-Match": first_response.headers["ETag"]}
+            self.assertEqual(client.get("/media?user=cacheuser&sort=name", headers=etag).status_code, 304)
+
+            with open(os.path.join(user_dir, "two.mp3"), "wb") as f:
+                f.write(b"x")
+            os.utime(user_dir, (2_000_000, 2_000_000))
+            third_response = client.get("/media?user=cacheuser&sort=name", headers=etag)
+            third = third_response.get_json()
+            self.assertEqual(third_response.status_code, 200)
+            self.assertEqual(mock_collect.call_count, 2)
+            self.assertEqual([m["name"] for m in third], ["two.mp3", "one.mp3"])
+
+    def test_list_media_picks_up_changes_in_subdirectories(self):
+        """Test files added to or removed from a subdirectory show up without a change to the user directory"""
+        user_dir = os.path.join(self.temp_dir, "subdiruser")
+        album_dir = os.path.join(user_dir, "album")
+        os.makedirs(album_dir)
+        with open(os.path.join(user_dir, "Song.mp3"), "wb") as f:
+            f.write(b"x")
+        os.utime(album_dir, (1_000_000, 1_000_000))
+        os.utime(user_dir, (1_000_000, 1_000_000))
+
+        client = app.test_client()
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            first = client.get("/media?user=subdiruser&sort=name").get_json()
+            with open(os.path.join(album_dir, "t.ogg"), "wb") as f:
+                f.write(b"x")
+            os.utime(album_dir, (2_000_000, 2_000_000))
+            os.utime(user_dir, (1_000_000, 1_000_000))
+            second = client.get("/media?user=subdiruser&sort=name").get_json()
+            os.remove(os.path.join(album_dir, "t.ogg"))
+            os.utime(album_dir, (3_000_000, 3_000_000))
+            os.utime(user_dir, (1_000_000, 1_000_000))
+            third = client.get("/media?user=subdiruser&sort=name").get_json()
+
+        self.assertEqual([m["path"] for m in first], ["Song.mp3"])
+        self.assertEqual(sorted(m["path"] for m in second), ["Song.mp3", os.path.join("album", "t.ogg")])
+        self.assertEqual([m["path"] for m in third], ["Song.mp3"])
+
+    def test_list_media_rescan_rereads_rewritten_meta(self):
+        """Test a re-download that rewrites the .meta file updates the indexed download date"""
+        user_dir = os.path.join(self.temp_dir, "metauser")
+        os.makedirs(user_dir)
+        meta_path = os.path.join(user_dir, "song.meta")
+        with open(os.path.join(user_dir, "song.mp3"), "wb") as f:
+            f.write(b"x")
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"download_date": 1.0}, f)
+        os.utime(user_dir, (1_000_000, 1_000_000))
+
+        client = app.test_client()
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            first = client.get("/media?user=metauser").get_json()
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"download_date": 99.0}, f)
+            os.utime(meta_path, ns=(0, os.stat(meta_path).st_mtime_ns + 10**9))
+            # Replacing the media file bumps the directory mtime
+            os.utime(user_dir, (2_000_000, 2_000_000))
+            second = client.get("/media?user=metauser").get_json()
+
+        self.assertEqual([m["date_downloaded"] for m in first], [1.0])
+        self.assertEqual([m["date_downloaded"] for m in second], [99.0])
+
+    def test_stream_file_range(self):
+        """Test range requests return 206 with only the requested bytes"""
+        user_dir = os.path.join(self.temp_dir, "streamuser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "song.mp3"), "wb") as f:
+            f.write(bytes(range(100)))
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            partial = client.get("/stream/song.mp3?user=streamuser", headers={"Range": "bytes=10-19"})
+            full = client.get("/stream/song.mp3?user=streamuser")
+
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.data, bytes(range(10, 20)))
+        self.assertEqual(partial.headers["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(partial.mimetype, "audio/mpeg")
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(full.data, bytes(range(100)))
+
+    def test_create_default_thumbnails_without_pillow(self):
+        """Test default thumbnails are copied from the bundled assets without importing PIL"""
+        media_dir = os.path.join(self.temp_dir, "defaults")
+        os.makedirs(media_dir)
+
+        with patch("webplayer.MEDIA_FOLDER", media_dir), patch.dict(sys.modules, {"PIL": None}):
+            create_default_thumbnails()
+            response = app.test_client().get("/thumbnail/default_audio_thumbnail.jpg?user=defaultsuser")
+
+        for filename in ("default_audio_thumbnail.jpg", "default_video_thumbnail.jpg"):
+            self.assertTrue(os.path.isfile(os.path.join(media_dir, filename)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/jpeg")
+
+    def test_stream_file_invalid_range(self):
+        """Test malformed or unsatisfiable ranges get 416 and open-ended ranges are clamped to the file"""
+        user_dir = os.path.join(self.temp_dir, "rangeuser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "song.mp3"), "wb") as f:
+            f.write(bytes(range(100)))
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            for range_header in ("bytes=abc", "bytes=200-300", "garbage"):
+                with self.subTest(range_header=range_header):
+                    response = client.get("/stream/song.mp3?user=rangeuser", headers={"Range": range_header})
+                    self.assertEqual(response.status_code, 416)
+                    self.assertEqual(response.headers["Content-Range"], "bytes */100")
+            clamped = client.get("/stream/song.mp3?user=rangeuser", headers={"Range": "bytes=90-500"})
+
+        self.assertEqual(clamped.status_code, 206)
+        self.assertEqual(clamped.headers["Content-Range"], "bytes 90-99/100")
+        self.assertEqual(clamped.headers["Content-Length"], "10")
+        self.assertEqual(clamped.data, bytes(range(90, 100)))
+
+    def test_stream_file_range_is_streamed_in_chunks(self):
+        """Test large ranges are streamed from the open file in small chunks instead of one full read"""
+        user_dir = os.path.join(self.temp_dir, "chunkuser")
+        os.makedirs(user_dir)
+        data = os.urandom(1 << 20)
+        with open(os.path.join(user_dir, "video.mp4"), "wb") as f:
+            f.write(data)
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            response = app.test_client().get(
+                "/stream/video.mp4?user=chunkuser", headers={"Range": "bytes=1000-"}, buffered=False
+            )
+            with closing(response):
+                chunks = list(response.response)
+
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_streamed)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 65536)
+        self.assertEqual(b"".join(chunks), data[1000:])
+
+    def test_stream_file_conditional_and_x_sendfile(self):
+        """Test streamed files revalidate with ETag and are offloaded via X-Sendfile when enabled"""
+        user_dir = os.path.join(self.temp_dir, "sendfileuser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "song.mp3"), "wb") as f:
+            f.write(bytes(range(100)))
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            first = client.get("/stream/song.mp3?user=sendfileuser")
+            revalidated = client.get(
+                "/stream/song.mp3?user=sendfileuser", headers={"If-None-Match": first.headers["ETag"]}
+            )
+            with patch.dict(app.config, {"USE_X_SENDFILE": True}):
+                offloaded = client.get("/stream/song.mp3?user=sendfileuser")
+
+        self.assertIn("Last-Modified", first.headers)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(offloaded.headers["X-Sendfile"], os.path.join(os.path.abspath(user_dir), "song.mp3"))
+        self.assertEqual(offloaded.data, b"")
+
+    def test_x_accel_redirect_and_thumbnail_caching(self):
+        """Test X-Sendfile becomes X-Accel-Redirect under the prefix and thumbnails are cacheable"""
+        user_dir = os.path.join(self.temp_dir, "acceluser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "cover.jpg"), "wb") as f:
+            f.write(b"jpg")
+
+        client = app.test_client()
+        with patch.dict(app.config, {"USE_X_SENDFILE": True}), patch("webplayer.X_ACCEL_PREFIX", "/internal/"):
+            static = client.get("/templates/style.css")
+            with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+                thumbnail = client.get("/thumbnail/cover.jpg?user=acceluser")
+
+        self.assertEqual(static.headers["X-Accel-Redirect"], "/internal/templates/style.css")
+        self.assertNotIn("X-Sendfile", static.headers)
+        # Files outside the aliased app directory keep the plain X-Sendfile header
+        self.assertIn("X-Sendfile", thumbnail.headers)
+        self.assertIn("public", thumbnail.headers["Cache-Control"])
+        self.assertIn("max-age=86400", thumbnail.headers["Cache-Control"])
+
+    def test_thumbnail_and_description_revalidate(self):
+        """Test thumbnails and descriptions answer repeat requests with 304 Not Modified"""
+        user_dir = os.path.join(self.temp_dir, "validatoruser")
+        os.makedirs(user_dir)
+        with open(os.path.join(user_dir, "song.jpg"), "wb") as f:
+            f.write(b"jpg")
+        with open(os.path.join(user_dir, "song.txt"), "w", encoding="utf-8") as f:
+            f.write("A description")
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            for url in ("/thumbnail/song.jpg?user=validatoruser", "/description/song.mp3?user=validatoruser"):
+                with self.subTest(url=url):
+                    first = client.get(url)
+                    self.assertEqual(first.status_code, 200)
+                    self.assertIn("Last-Modified", first.headers)
+                    repeat = client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+                    self.assertEqual(repeat.status_code, 304)
+                    self.assertEqual(repeat.data, b"")
+            description = client.get("/description/song.mp3?user=validatoruser")
+            missing = client.get("/description/other.mp3?user=validatoruser")
+
+        self.assertEqual(description.mimetype, "text/plain")
+        self.assertEqual(description.get_data(as_text=True), "A description")
+        self.assertEqual(missing.status_code, 404)
+
+    def test_thumbnail_serves_resized_webp(self):
+        """Test thumbnails are served as a cached 256px WebP copy that is refreshed when the original changes"""
+        from PIL import Image
+
+        user_dir = os.path.join(self.temp_dir, "webpuser")
+        os.makedirs(user_dir)
+        original = os.path.join(user_dir, "song.jpg")
+        Image.new("RGB", (1280, 720), color=(10, 20, 30)).save(original)
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            response = client.get("/thumbnail/song.jpg?user=webpuser")
+            self.assertEqual(response.mimetype, "image/webp")
+            with Image.open(io.BytesIO(response.data)) as img:
+                self.assertEqual(img.size, (256, 144))
+
+            # A newer original (e.g. from a re-download) replaces the cached copy
+            Image.new("RGB", (720, 1280), color=(10, 20, 30)).save(original)
+            os.utime(original, ns=(os.stat(original).st_atime_ns, os.stat(original).st_mtime_ns + 10**9))
+            response = client.get("/thumbnail/song.jpg?user=webpuser")
+            with Image.open(io.BytesIO(response.data)) as img:
+                self.assertEqual(img.size, (144, 256))
+
+        self.assertTrue(os.path.exists(os.path.join(user_dir, "song.jpg.thumb.webp")))
+
+    def test_thumbnail_variants_per_original_and_inside_user_dir(self):
+        """Test same-stem images get separate WebP copies and paths leaving the user directory write nothing"""
+        from PIL import Image
+
+        user_dir = os.path.join(self.temp_dir, "variantuser")
+        outside_dir = os.path.join(self.temp_dir, "outside")
+        os.makedirs(user_dir)
+        os.makedirs(outside_dir)
+        Image.new("RGB", (512, 512)).save(os.path.join(user_dir, "song.jpg"))
+        Image.new("RGB", (512, 256)).save(os.path.join(user_dir, "song.png"))
+        Image.new("RGB", (512, 512)).save(os.path.join(outside_dir, "secret.jpg"))
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            client = app.test_client()
+            sizes = []
+            for name in ("song.jpg", "song.png"):
+                with Image.open(io.BytesIO(client.get(f"/thumbnail/{name}?user=variantuser").data)) as img:
+                    sizes.append(img.size)
+            escape = client.get("/thumbnail/..%2Foutside%2Fsecret.jpg?user=variantuser")
+
+        self.assertEqual(sizes, [(256, 256), (256, 128)])
+        self.assertEqual(escape.status_code, 404)
+        self.assertEqual(os.listdir(outside_dir), ["secret.jpg"])
+
+    def test_search_returns_thumbnails_without_probing(self):
+        """Test search results carry hq720 and hqdefault thumbnails without any HTTP requests"""
+        mock_ytsearch = MagicMock()
+        mock_ytsearch.YTSearch.return_value.search_by_term.return_value = [{"id": "abc123", "title": "Song"}]
+
+        with (
+            patch("webplayer.ytsearch", mock_ytsearch),
+            patch("webplayer.http_session") as mock_session,
+            patch("webplayer.SEARCH_MIN_INTERVAL", 0),
+            patch.dict("webplayer._search_cache", clear=True),
+        ):
+            response = app.test_client().post("/search", data={"query": "song"})
+
+        mock_session.head.assert_not_called()
+        result = response.get_json()["results"][0]
+        self.assertEqual(result["thumbnail"], "https://i.ytimg.com/vi/abc123/hq720.jpg")
+        self.assertEqual(result["thumbnail_fallback"], "https://i.ytimg.com/vi/abc123/hqdefault.jpg")
+
+    def test_search_caches_results_per_query(self):
+        """Test repeated searches for the same query are answered from the cache"""
+        mock_ytsearch = MagicMock()
+        mock_ytsearch.YTSearch.return_value.search_by_term.return_value = [{"id": "abc123", "title": "Song"}]
+        client = app.test_client()
+
+        with (
+            patch("webplayer.ytsearch", mock_ytsearch),
+            patch("webplayer.SEARCH_MIN_INTERVAL", 0),
+            patch.dict("webplayer._search_cache", clear=True),
+        ):
+            first = client.post("/search", data={"query": "Song"}).get_json()
+            second = client.post("/search", data={"query": "  song "}).get_json()
+            client.post("/search", data={"query": "other"})
+
+        self.assertEqual(first, second)
+        self.assertEqual(mock_ytsearch.YTSearch.return_value.search_by_term.call_count, 2)
+
+    @patch("webplayer.safe_subprocess_run", return_value=subprocess.CompletedProcess([], 0, stdout="", stderr=""))
+    def test_extract_mp3_stream_copies_mp3_audio(self, mock_run):
+        """Test MP3 audio is remuxed without re-encoding and other codecs are encoded with libmp3lame"""
+        with patch("webplayer.probe_audio_codec", return_value="mp3"):
+            extract_mp3(self.test_video_path, self.test_audio_path)
+        cmd = mock_run.call_args.args[0]
+        self.assertIn("copy", cmd)
+        self.assertNotIn("libmp3lame", cmd)
+        # The copied stream is the one whose codec was probed
+        self.assertEqual(cmd[cmd.index("-map") + 1], "0:a:0")
+
+        with patch("webplayer.probe_audio_codec", return_value="aac"):
+            extract_mp3(self.test_video_path, self.test_audio_path)
+        cmd = mock_run.call_args.args[0]
+        self.assertIn("libmp3lame", cmd)
+        self.assertNotIn("copy", cmd)
+
+    def test_download_runs_in_background_job(self):
+        """Test /download returns a job id, announces completion and /download/status reports the result"""
+        result = {"success": True, "message": "Successfully downloaded: v"}
+        client = app.test_client()
+        for source, download_function in (
+            ("youtube", "download_video_and_description"),
+            ("soundcloud", "download_soundcloud_track"),
+        ):
+            with self.subTest(source=source):
+                form = {
+                    "url": "https://example.com/v",
+                    "source": source,
+                    "user": "jobuser",
+                    "legal_acknowledgment": "1",
+                }
+                completed = threading.Event()
+                with (
+                    patch("webplayer.MEDIA_FOLDER", self.temp_dir),
+                    patch(f"webplayer.{download_function}", return_value=result) as mock_download,
+                    patch("webplayer.socketio.emit", side_effect=lambda *args, **kwargs: completed.set()) as mock_emit,
+                ):
+                    job_id = client.post("/download", data=form).get_json()["job_id"]
+                    self.assertTrue(completed.wait(timeout=5))
+                    status = client.get(f"/download/status/{job_id}").get_json()
+
+                mock_download.assert_called_once_with(
+                    "https://example.com/v", output_path=os.path.join(self.temp_dir, "jobuser")
+                )
+                mock_emit.assert_called_once_with("download_complete", {"job_id": job_id})
+                self.assertEqual(status, {**result, "status": "done"})
+                self.assertEqual(client.get(f"/download/status/{job_id}").status_code, 404)
+
+    def test_finished_download_jobs_expire(self):
+        """Test finished jobs whose status is never fetched are dropped when later jobs are submitted"""
+        finished = threading.Event()
+        with (
+            patch("webplayer.DOWNLOAD_JOB_TTL", 0),
+            patch("webplayer.socketio.emit", side_effect=lambda *args, **kwargs: finished.set()),
+        ):
+            abandoned = submit_download_job(lambda: {"success": True, "message": "done"})
+            self.assertTrue(finished.wait(timeout=5))
+            submit_download_job(lambda: {"success": True, "message": "done"})
+
+        self.assertEqual(app.test_client().get(f"/download/status/{abandoned}").status_code, 404)
+
+    def test_reconcile_media_index(self):
+        """Test the startup pass indexes every user directory and drops users that are gone"""
+        media_root = os.path.join(self.temp_dir, "reconcile")
+        for user in ("alice", "bob"):
+            os.makedirs(os.path.join(media_root, user))
+            with open(os.path.join(media_root, user, f"{user}.mp3"), "wb") as f:
+                f.write(b"x")
+
+        with patch("webplayer.MEDIA_FOLDER", media_root):
+            reconcile_media_index()
+            shutil.rmtree(os.path.join(media_root, "bob"))
+            reconcile_media_index()
+            with closing(open_media_index()) as connection:
+                rows = connection.execute("SELECT user, rel_path FROM media").fetchall()
+
+        self.assertEqual([tuple(row) for row in rows], [("alice", "alice.mp3")])
+
+    @patch("webplayer.PROGRESS_EMIT_INTERVAL", 60)
+    @patch("webplayer.socketio.emit")
+    def test_run_download_process_throttles_progress(self, mock_emit):
+        """Test progress updates within the emit interval are dropped, except the final 100%"""
+        script = "import sys; sys.stdout.write(''.join(f'[download] {p / 10:.1f}%\\n' for p in range(0, 1001)))"
+        run_download_process([sys.executable, "-c", script], self.temp_dir)
+        progress = [c.args[1]["progress"] for c in mock_emit.call_args_list]
+        self.assertEqual(progress, [0.0, 100.0])
+
+    @patch("webplayer.run_download_process", side_effect=_fake_ytdlp_download_without_thumbnail)
+    def test_download_video_and_description_fetches_missing_thumbnail(self, mock_download):
+        """Test the thumbnail is fetched over HTTP when yt-dlp did not write one"""
+        output_path = os.path.join(self.temp_dir, "fetches_missing_thumbnail")
+        response = MagicMock(headers={"Content-Length": "64"}, raw=io.BytesIO(b"jpeg bytes"))
+        response.__enter__.return_value = response
+        with patch("webplayer.http_session.get", return_value=response) as mock_get:
+            result = download_video_and_description("https://example.com/watch?v=t", output_path=output_path)
+
+        self.assertTrue(result["success"])
+        mock_get.assert_called_once_with(
+            "https://example.com/thumb.jpg", stream=True, timeout=10, headers={"Accept-Encoding": "identity"}
+        )
+        # The response is closed so its connection goes back to the pool
+        response.__exit__.assert_called_once()
+        with open(os.path.join(output_path, "No Thumb.jpg"), "rb") as f:
+            self.assertEqual(f.read(), b"jpeg bytes")
+
+    def test_collect_media_files_caches_parsed_meta(self):
+        """Test .meta files are parsed once per modification and re-read after being rewritten"""
+        user_dir = os.path.join(self.temp_dir, "metacacheuser")
+        os.makedirs(user_dir)
+        meta_path = os.path.join(user_dir, "song.meta")
+        with open(os.path.join(user_dir, "song.mp3"), "wb") as f:
+            f.write(b"x")
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"download_date": 1.0}, f)
+
+        with patch("webplayer.json.load", wraps=json.load) as mock_load:
+            first = collect_media_files(user_dir)
+            second = collect_media_files(user_dir)
+            self.assertEqual(mock_load.call_count, 1)
+
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"download_date": 2.0}, f)
+            os.utime(meta_path, ns=(0, os.stat(meta_path).st_mtime_ns + 10**9))
+            third = collect_media_files(user_dir)
+
+        self.assertEqual(mock_load.call_count, 2)
+        self.assertEqual([m["date_downloaded"] for m in first + second + third], [1.0, 1.0, 2.0])
+
+    def test_delete_files_removes_media_and_sidecars(self):
+        """Test deleting media removes its sidecar files and ignores ones that do not exist"""
+        user_dir = os.path.join(self.temp_dir, "deleteuser")
+        os.makedirs(user_dir)
+        for name in ("song.mp3", "song.jpg", "song.meta", "song.jpg.thumb.webp", "other.mp3"):
+            with open(os.path.join(user_dir, name), "wb") as f:
+                f.write(b"x")
+
+        with patch("webplayer.MEDIA_FOLDER", self.temp_dir):
+            response = app.test_client().post(
+                "/delete", json={"files": ["song.mp3", "missing.mp3"], "user": "deleteuser"}
+            )
+
+        result = response.get_json()
+        self.assertTrue(result["success"])
+        self.assertEqual(result["deleted_files"], ["song.mp3"])
+        self.assertNotIn("errors", result)
+        self.assertEqual(os.listdir(user_dir), ["other.mp3"])
+
+    def test_extract_mp3_retries_with_reencode(self):
+        """Test a failed stream copy is retried once with an MP3 re-encode"""
+        results = [
+            subprocess.CompletedProcess([], 1, stdout="", stderr="copy failed"),
+            subprocess.CompletedProcess([], 0, stdout="", stderr=""),
+        ]
+        with (
+            patch("webplayer.probe_audio_codec", return_value="mp3"),
+            patch("webplayer.safe_subprocess_run", side_effect=results) as mock_run,
+        ):
+            extract_mp3(self.test_video_path, self.test_audio_path)
+
+        self.assertEqual(mock_run.call_count, 2)
+        self.assertIn("libmp3lame", mock_run.call_args.args[0])
+
+        failures = [subprocess.CompletedProcess([], 1, stdout="", stderr="bad input")] * 2
+        with (
+            patch("webplayer.probe_audio_codec", return_value="aac"),
+            patch("webplayer.safe_subprocess_run", side_effect=failures),
+        ):
+            with self.assertRaises(Exception):
+                extract_mp3(self.test_video_path, self.test_audio_path)
 
     def test_sanitize_filename_length_limit(self):
         """Test filename sanitization with length limits"""
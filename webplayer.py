@@ -1,16 +1,28 @@
+import collections
+import contextlib
+import functools
+import hashlib
 import json
 import mimetypes
 import os
 import re
+import selectors
 import shutil
+import sqlite3
 import subprocess
+import sys
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 import requests
-from flask import Flask, Response, abort, jsonify, render_template, request, send_from_directory
+from flask import Flask, abort, jsonify, render_template, request, send_from_directory
 from flask_socketio import SocketIO
-from moviepy import VideoFileClip
+from requests.adapters import HTTPAdapter
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 
 try:
     import youtube_dl
@@ -23,12 +35,101 @@ app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_prefix=1)
 app.secret_key = os.urandom(24)
 socketio = SocketIO(app, cors_allowed_origins="*")
-PREFIX = os.environ.get("SCRIPT_NAME", "")
+# Nginx internal location aliasing the app directory (e.g. /internal/); X-Sendfile becomes X-Accel-Redirect
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+# Behind Apache (mod_xsendfile), lighttpd or Nginx let the front-end server send files with sendfile(2)
+USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE or bool(X_ACCEL_PREFIX)
+
+# Shared HTTP session so outgoing requests reuse pooled (keep-alive) connections
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
 
 MEDIA_FOLDER = "downloads"
+# yt-dlp cache (player JS, signature functions) kept on the media volume so it survives container rebuilds
+# (absolute, since yt-dlp runs with the user directory as its working directory)
+YTDLP_CACHE_DIR = os.path.abspath(os.environ.get("YTDLP_CACHE_DIR", os.path.join(MEDIA_FOLDER, ".cache", "yt-dlp")))
+# ffmpeg hardware decoder for video input (e.g. vaapi, qsv, cuda, auto); empty disables it
+FFMPEG_HWACCEL = os.environ.get("FFMPEG_HWACCEL", "")
 ALLOWED_AUDIO_EXTENSIONS = {".mp3", ".wav", ".ogg", ".flac", ".aac", ".m4a"}
 ALLOWED_VIDEO_EXTENSIONS = {".mp4", ".webm", ".avi", ".mov", ".mkv"}
-ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+# Ordered: it is also the sidecar thumbnail lookup order (a set would depend on string hash randomization)
+ALLOWED_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+# Placeholder thumbnails shipped with the app and copied into MEDIA_FOLDER on startup
+DEFAULT_THUMBNAIL_ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "assets")
+DEFAULT_THUMBNAILS = ("default_audio_thumbnail.jpg", "default_video_thumbnail.jpg")
+# Thumbnails are displayed at 100px at most; a 256px WebP copy is served in place of the original
+THUMBNAIL_VARIANT_SIZE = (256, 256)
+THUMBNAIL_VARIANT_SUFFIX = ".thumb.webp"
+
+# Characters that are not allowed in file names, stripped with a single str.translate pass
+_INVALID_FILENAME_CHARS = '\\/*?:"<>|#'
+_STRIP_TABLE = str.maketrans("", "", _INVALID_FILENAME_CHARS)
+
+# Downloads run in a small pool off the request thread; the work itself happens in yt-dlp and
+# ffmpeg child processes, so threads are enough and socketio.emit keeps working from them
+DOWNLOAD_WORKERS = int(os.environ.get("DL_WORKERS", "2"))
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+download_jobs = {}
+# Finished jobs are dropped once their status is fetched, or after this many seconds if it never is
+DOWNLOAD_JOB_TTL = 3600
+download_job_finish_times = {}
+
+# SQLite index of each user's media, kept in MEDIA_FOLDER and refreshed when a user directory changes
+MEDIA_INDEX_FILENAME = "media_index.db"
+_MEDIA_INDEX_VERSION = 1
+_MEDIA_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    user TEXT NOT NULL,
+    rel_path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size REAL NOT NULL,
+    date_modified REAL NOT NULL,
+    date_downloaded REAL NOT NULL,
+    thumbnail TEXT NOT NULL,
+    PRIMARY KEY (user, rel_path)
+);
+CREATE INDEX IF NOT EXISTS media_user_date_downloaded ON media (user, date_downloaded);
+CREATE INDEX IF NOT EXISTS media_user_date_modified ON media (user, date_modified);
+CREATE INDEX IF NOT EXISTS media_user_name ON media (user, name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS media_user_size ON media (user, size);
+CREATE TABLE IF NOT EXISTS media_dirs (
+    user TEXT PRIMARY KEY,
+    signature TEXT
+);
+"""
+# /media sort options mapped to ORDER BY columns (never interpolate request values directly)
+_MEDIA_SORT_COLUMNS = {
+    "name": "name COLLATE NOCASE",
+    "date": "date_modified",
+    "date_downloaded": "date_downloaded",
+    "size": "size",
+}
+
+# yt-dlp output parsing
+_LINE_BREAK_RE = re.compile(rb"\r\n|\r|\n")
+# Only yt-dlp's own progress lines; titles in e.g. "[download] Destination: 100% ..." are not progress
+_PROGRESS_RE = re.compile(rb"\[download\]\s+(\d+(?:\.\d+)?)%")
+# Minimum seconds between download_progress events (a final 100% is always sent)
+PROGRESS_EMIT_INTERVAL = 0.2
+# YouTube search results are shared across users for identical queries; cache misses go out one at a
+# time and at most once per SEARCH_MIN_INTERVAL seconds to stay under YouTube's throttling
+SEARCH_CACHE_TTL = 600
+SEARCH_CACHE_SIZE = 1024
+SEARCH_MIN_INTERVAL = 1.0
+_search_cache = {}  # normalized query -> (expires_at, results)
+_search_lock = threading.Lock()
+_last_search_time = float("-inf")
+
+# Lines of yt-dlp stderr kept for the error message; a long download with warnings can print thousands
+STDERR_TAIL_LINES = 50
+# Only the fields the app reads, instead of the full info JSON with every format, thumbnail and subtitle URL
+_YTDLP_INFO_TEMPLATE = "%(.{title,description,thumbnail})j"
+_YTDLP_ERROR_RE = re.compile(
+    r"error:|unable to download|http error|network error|video unavailable|private video|age-restricted",
+    re.IGNORECASE,
+)
 
 if not os.path.exists(MEDIA_FOLDER):
     os.makedirs(MEDIA_FOLDER)
@@ -48,11 +149,8 @@ def sanitize_filename(filename, max_length=200):
     Returns:
         str: Sanitized filename
     """
-    # Remove invalid characters
-    sanitized = re.sub(r'[\\/*?:"<>|#]', "", filename)
-
-    # Remove leading/trailing whitespace and dots
-    sanitized = sanitized.strip(" .")
+    # Remove invalid characters and leading/trailing whitespace and dots
+    sanitized = filename.translate(_STRIP_TABLE).strip(" .")
 
     # Limit length while preserving file extension if present
     if len(sanitized) > max_length:
@@ -76,6 +174,7 @@ def sanitize_filename(filename, max_length=200):
     return sanitized
 
 
+@functools.lru_cache(maxsize=1024)
 def normalize_username(username):
     """
     Normalize username to lowercase for consistent directory naming
@@ -154,63 +253,440 @@ def safe_subprocess_run(cmd, **kwargs):
         raise Exception(f"Error running command {' '.join(cmd)} in directory {cwd}: {str(e)}")
 
 
+def probe_audio_codec(input_file):
+    """
+    Get the codec of the first audio stream in a media file using ffprobe.
+
+    Args:
+        input_file (str): Path to the media file
+
+    Returns:
+        str or None: Codec name (e.g. "mp3", "aac", "opus"), or None if it could not be determined
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "a:0",
+        "-show_entries",
+        "stream=codec_name",
+        "-of",
+        "json",
+        input_file,
+    ]
+    try:
+        result = safe_subprocess_run(cmd, capture_output=True, text=True, timeout=30)
+        if result.returncode != 0:
+            print(f"ffprobe failed: {result.stderr}")
+            return None
+        streams = json.loads(result.stdout).get("streams", [])
+        return streams[0].get("codec_name") if streams else None
+    except Exception as e:
+        print(f"Warning: Could not probe audio codec: {e}")
+        return None
+
+
+def ffmpeg_input_args(input_file, decode_video=False):
+    """
+    Build the ffmpeg input arguments for a file.
+
+    Hardware-accelerated decoding (FFMPEG_HWACCEL) is only requested when the
+    video stream is actually decoded; audio-only extraction with -vn skips it.
+
+    Args:
+        input_file (str): Path to the input media file
+        decode_video (bool): Whether the command decodes the video stream
+
+    Returns:
+        list: ffmpeg arguments ending with "-i <input_file>"
+    """
+    if decode_video and FFMPEG_HWACCEL:
+        return ["-hwaccel", FFMPEG_HWACCEL, "-i", input_file]
+    return ["-i", input_file]
+
+
+def mp3_encode_args(bitrate="192k"):
+    """
+    Build the ffmpeg arguments that encode the audio stream to MP3.
+
+    Args:
+        bitrate (str): Target bitrate (default: 192k)
+
+    Returns:
+        list: ffmpeg audio encoding arguments
+    """
+    return [
+        "-acodec",
+        "libmp3lame",  # MP3 codec
+        "-ab",
+        bitrate,
+        "-ar",
+        "44100",  # 44.1kHz sample rate
+        "-threads",
+        "0",  # Let ffmpeg pick the thread count
+    ]
+
+
 def extract_mp3(input_file, output_file):
     """
-    Extract audio from video file and save as MP3.
-    Uses ffmpeg directly for better reliability.
-    Falls back to moviepy if ffmpeg direct call fails.
+    Extract audio from video file and save as MP3 using ffmpeg.
+    MP3 audio is stream-copied, anything else is encoded with libmp3lame.
+    If the first attempt fails, ffmpeg is retried once with a re-encode.
     """
     if not output_file.lower().endswith(".mp3"):
         output_file += ".mp3"
 
-    # Try ffmpeg directly first (more reliable)
-    try:
-        print(f"Attempting audio extraction with ffmpeg: {input_file} -> {output_file}")
+    if probe_audio_codec(input_file) == "mp3":
+        # Source audio is already MP3, remux the stream without re-encoding
+        attempts = [["-c:a", "copy"], mp3_encode_args("192k")]
+    else:
+        attempts = [mp3_encode_args("192k"), mp3_encode_args("128k")]
+
+    errors = []
+    for audio_args in attempts:
+        print(f"Attempting audio extraction with ffmpeg ({' '.join(audio_args[:2])}): {input_file} -> {output_file}")
         cmd = [
             "ffmpeg",
-            "-i",
-            input_file,
+            "-hide_banner",
+            "-loglevel",
+            "error",  # Only report errors on stderr
+            *ffmpeg_input_args(input_file),
+            "-map",
+            "0:a:0",  # The audio stream probed above, not ffmpeg's own pick among several
             "-vn",  # No video
-            "-acodec",
-            "libmp3lame",  # MP3 codec
-            "-ab",
-            "192k",  # 192kbps bitrate
-            "-ar",
-            "44100",  # 44.1kHz sample rate
+            *audio_args,
             "-y",  # Overwrite output file
             output_file,
         ]
 
-        result = safe_subprocess_run(cmd, capture_output=True, text=True, timeout=300)  # 5 min timeout
+        try:
+            result = safe_subprocess_run(cmd, capture_output=True, text=True, timeout=300)  # 5 min timeout
+        except Exception as e:
+            print(f"ffmpeg failed: {str(e)}")
+            errors.append(str(e))
+            continue
 
-        if result.returncode != 0:
-            error_msg = result.stderr or "Unknown ffmpeg error"
-            print(f"ffmpeg failed: {error_msg}")
-            raise Exception(f"ffmpeg extraction failed: {error_msg}")
+        if result.returncode == 0:
+            print(f"ffmpeg audio extraction successful: {output_file}")
+            return
+
+        error_msg = result.stderr or "Unknown ffmpeg error"
+        print(f"ffmpeg failed: {error_msg}")
+        errors.append(error_msg)
+
+    raise Exception(f"ffmpeg audio extraction failed: {' | '.join(errors)}")
 
-        print(f"ffmpeg audio extraction successful: {output_file}")
+
+def log_raw_output(raw_line):
+    """
+    Write a line of subprocess output to stdout without decoding it.
+
+    Args:
+        raw_line (bytes): Output line without its line break
+    """
+    stdout_buffer = getattr(sys.stdout, "buffer", None)
+    if stdout_buffer is None:
+        print(raw_line.decode("utf-8", errors="replace"))
         return
+    # Flush pending text first so raw lines stay in order with print() output
+    sys.stdout.flush()
+    stdout_buffer.write(raw_line + b"\n")
+
+
+def ensure_thumbnail_variant(image_path):
+    """
+    Create or refresh the resized WebP copy of a thumbnail, stored next to it as <name>.thumb.webp.
+
+    The variant keeps the original's extension in its name, so song.jpg and song.png get separate copies.
+
+    The copy is regenerated whenever the original is newer, so a re-download replaces it.
+
+    Args:
+        image_path (str): Path to the original thumbnail image
+
+    Returns:
+        str: Path to the WebP copy, or None if it could not be created
+    """
+    variant_path = image_path + THUMBNAIL_VARIANT_SUFFIX
+    try:
+        if os.stat(variant_path).st_mtime_ns >= os.stat(image_path).st_mtime_ns:
+            return variant_path
+    except FileNotFoundError:
+        pass
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+
+    # Each request writes its own temp file, so concurrent requests for the same thumbnail don't collide
+    temp_path = f"{variant_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with Image.open(image_path) as img:
+            img.thumbnail(THUMBNAIL_VARIANT_SIZE, Image.LANCZOS)
+            img.save(temp_path, "WEBP", quality=80, method=4)
+        os.replace(temp_path, variant_path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not create thumbnail variant for {image_path}: {e}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        return None
+    return variant_path
+
+
+def run_download_process(cmd, cwd, timeout=1800):
+    """
+    Run a yt-dlp download, emitting progress over socketio as it is printed.
+
+    stdout and stderr are polled together, so a quiet stream never holds up
+    lines (and progress updates) arriving on the other one and neither pipe
+    can fill up and stall yt-dlp. They are kept apart so that error messages
+    are built from stderr only, without progress lines mixed in.
+
+    Args:
+        cmd (list): yt-dlp command to run
+        cwd (str): Working directory for the download
+        timeout (int): Maximum runtime in seconds (default: 30 minutes)
+
+    Returns:
+        tuple: (returncode: int, stderr_output: list of str, the last STDERR_TAIL_LINES lines)
+    """
+    try:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,  # Set working directory to output path
+        )
+    except FileNotFoundError:
+        raise Exception(f"Command not found: {cmd[0]}. Please ensure it's installed and in PATH.")
+
+    stderr_output = collections.deque(maxlen=STDERR_TAIL_LINES)
+    start_time = time.time()
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+    selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+    pending = {"stdout": b"", "stderr": b""}
+    last_emit_time = float("-inf")
+
+    try:
+        while selector.get_map():
+            # Check for timeout
+            if time.time() - start_time > timeout:
+                raise Exception(f"Download timeout - process exceeded {timeout} seconds")
+
+            for key, _ in selector.select(timeout=1.0):
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    # yt-dlp redraws progress with \r, so treat it as a line break too
+                    *raw_lines, pending[key.data] = _LINE_BREAK_RE.split(pending[key.data] + chunk)
+                else:
+                    selector.unregister(key.fileobj)
+                    raw_lines, pending[key.data] = [pending[key.data]], b""
+
+                for raw_line in raw_lines:
+                    raw_line = raw_line.strip()
+                    if not raw_line:
+                        continue
+
+                    if key.data == "stdout":
+                        # Progress lines are logged as raw bytes; only the matched percentage is parsed
+                        log_raw_output(raw_line)
+                        match = _PROGRESS_RE.search(raw_line)
+                        if match:
+                            progress = float(match.group(1))
+                            now = time.monotonic()
+                            # At most one update per PROGRESS_EMIT_INTERVAL, always sending 100%
+                            if now - last_emit_time >= PROGRESS_EMIT_INTERVAL or progress >= 100.0:
+                                socketio.emit("download_progress", {"progress": progress})
+                                last_emit_time = now
+                        continue
+
+                    # stderr is short and feeds the error message, so it is still decoded
+                    line = raw_line.decode("utf-8", errors="replace")
+                    stderr_output.append(line)
+                    print(f"yt-dlp stderr: {line}")
+
+                    # Check for specific error patterns that indicate failure
+                    if _YTDLP_ERROR_RE.search(line):
+                        print(f"Detected critical error in stderr: {line}")
+
+        # Both pipes are closed; wait for the process to exit and get final return code
+        process.wait(timeout=max(timeout - (time.time() - start_time), 1))
+    except Exception:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+
+    return process.returncode, list(stderr_output)
+
+
+def submit_download_job(func, *args, **kwargs):
+    """
+    Run a download function in the download pool.
+
+    Args:
+        func (callable): Download function returning a result dict
+        *args, **kwargs: Arguments for func
+
+    Returns:
+        str: Job id to query with /download/status/<job_id>
+    """
+    prune_download_jobs()
+    job_id = uuid.uuid4().hex
+    future = download_executor.submit(func, *args, **kwargs)
+    download_jobs[job_id] = future
+
+    # Runs once the result is set, so a client fetching the status on this event sees it done
+    def job_done(_):
+        download_job_finish_times[job_id] = time.monotonic()
+        socketio.emit("download_complete", {"job_id": job_id})
+
+    future.add_done_callback(job_done)
+    return job_id
+
+
+def prune_download_jobs():
+    """Forget finished download jobs whose status was not fetched within DOWNLOAD_JOB_TTL seconds."""
+    cutoff = time.monotonic() - DOWNLOAD_JOB_TTL
+    # Snapshot, since done callbacks add entries from the pool threads
+    for job_id, finished_at in list(download_job_finish_times.items()):
+        if finished_at <= cutoff:
+            download_jobs.pop(job_id, None)
+            download_job_finish_times.pop(job_id, None)
+
+
+def pipe_audio_download(url, output_path, download_stem, timeout=600):
+    """
+    Download the best audio stream and encode it to MP3 while it downloads.
+
+    yt-dlp writes the stream to stdout and ffmpeg encodes it from stdin, so the
+    encode overlaps the download and the source audio is never written to disk.
+    The info JSON and thumbnail are still written next to the MP3.
+
+    Args:
+        url (str): Media URL
+        output_path (str): Directory to write into
+        download_stem (str): File name stem for the MP3, info JSON and thumbnail
+        timeout (int): Maximum runtime in seconds (default: 10 minutes)
+
+    Returns:
+        bool: True if the MP3 was written, False if the pipeline failed
+    """
+    cmd_ytdlp = [
+        "yt-dlp",
+        "--no-warnings",
+        "--cache-dir",
+        YTDLP_CACHE_DIR,
+        "--print-to-file",
+        _YTDLP_INFO_TEMPLATE,
+        f"{download_stem}.info.json",
+        "--write-thumbnail",
+        "--convert-thumbnails",
+        "jpg",
+        "--format",
+        "bestaudio/best",
+        "--retries",
+        "3",
+        "--fragment-retries",
+        "3",
+        "-o",
+        "-",  # Media to stdout
+        "-o",
+        f"thumbnail:{download_stem}.%(ext)s",
+        url,
+    ]
+    audio_output = f"{download_stem}.mp3"
+    cmd_ffmpeg = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        "pipe:0",
+        "-vn",
+        "-c:a",
+        "libmp3lame",
+        "-b:a",
+        "192k",
+        "-f",
+        "mp3",
+        "-y",
+        audio_output,
+    ]
+
+    print(
+        f"Executing piped audio download in directory '{output_path}': {' '.join(cmd_ytdlp)} | {' '.join(cmd_ffmpeg)}"
+    )
+    try:
+        ytdlp_process = subprocess.Popen(cmd_ytdlp, stdout=subprocess.PIPE, cwd=output_path)
+    except FileNotFoundError:
+        print("Piped audio download failed: yt-dlp not found")
+        return False
+    try:
+        ffmpeg_process = subprocess.Popen(
+            cmd_ffmpeg, stdin=ytdlp_process.stdout, stderr=subprocess.PIPE, text=True, cwd=output_path
+        )
+    except FileNotFoundError:
+        print("Piped audio download failed: ffmpeg not found")
+        ytdlp_process.kill()
+        ytdlp_process.wait()
+        return False
+    # ffmpeg owns the read end now; closing ours lets yt-dlp see a broken pipe if ffmpeg exits early
+    ytdlp_process.stdout.close()
+
+    try:
+        _, ffmpeg_error = ffmpeg_process.communicate(timeout=timeout)
+        ytdlp_process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        for process in (ffmpeg_process, ytdlp_process):
+            process.kill()
+            process.wait()
+        ffmpeg_error = f"timeout after {timeout} seconds"
+
+    if ytdlp_process.returncode == 0 and ffmpeg_process.returncode == 0:
+        return True
+
+    print(
+        f"Piped audio download failed (yt-dlp exit code {ytdlp_process.returncode}, "
+        f"ffmpeg exit code {ffmpeg_process.returncode}): {ffmpeg_error}"
+    )
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(output_path, audio_output))
+    return False
 
-    except Exception as e:
-        print(f"ffmpeg extraction failed: {str(e)}, trying moviepy fallback...")
 
-        # Fallback to moviepy
+def find_existing_download(output_path, url):
+    """
+    Look for an earlier download of the same URL whose media is still in the directory.
+
+    Args:
+        output_path (str): Download directory
+        url (str): Video URL
+
+    Returns:
+        str: Title of the earlier download, or None if there is none
+    """
+    with os.scandir(output_path) as it:
+        entries = {entry.name: entry for entry in it}
+    for name, entry in entries.items():
+        if not name.endswith(".meta"):
+            continue
         try:
-            video = VideoFileClip(input_file)
-            if video.audio is None:
-                video.close()
-                raise Exception("No audio track found in video file")
-
-            audio = video.audio
-            audio.write_audiofile(output_file, codec="mp3", bitrate="192k", verbose=False, logger=None)
-            video.close()
-            print(f"MoviePy audio extraction successful: {output_file}")
-
-        except Exception as moviepy_error:
-            print(f"MoviePy extraction also failed: {str(moviepy_error)}")
-            raise Exception(
-                f"Both ffmpeg and moviepy audio extraction failed. ffmpeg: {str(e)}, moviepy: {str(moviepy_error)}"
-            )
+            metadata = load_media_metadata(entry.path, entry.stat().st_mtime_ns)
+        except (OSError, ValueError):
+            continue
+        if metadata.get("source_url") != url:
+            continue
+        base_name = name[: -len(".meta")]
+        if any(base_name + ext in entries for ext in ALLOWED_VIDEO_EXTENSIONS | ALLOWED_AUDIO_EXTENSIONS):
+            return metadata.get("original_title") or base_name
+    return None
 
 
 def download_video_and_description(url, output_path=None):
@@ -231,36 +707,32 @@ def download_video_and_description(url, output_path=None):
 
         print(f"Directory validated: {output_path}")
 
-        # Get video information
-        cmd_info = ["yt-dlp", "--dump-json", url]
-        result = safe_subprocess_run(cmd_info, capture_output=True, text=True, timeout=30)
-
-        if result.returncode != 0:
-            error_msg = result.stderr or "Unknown error getting video info"
-            print(f"Error getting video info: {error_msg}")
-            raise Exception(f"Error getting video info: {error_msg}")
-
-        try:
-            video_info = json.loads(result.stdout)
-        except json.JSONDecodeError as e:
-            raise Exception(f"Invalid JSON response from yt-dlp: {e}")
-
-        title = video_info.get("title", "untitled")
-        description = video_info.get("description", "")
-        thumbnail_url = video_info.get("thumbnail")
-
-        # Sanitize filename with length limits
-        safe_title = sanitize_filename(title)
+        # Files are only renamed to the title after the download, so yt-dlp's --no-overwrites cannot
+        # see an earlier download of the same URL; skip it here instead
+        existing_title = find_existing_download(output_path, url)
+        if existing_title:
+            print(f"Already downloaded: {existing_title}")
+            return {"success": True, "message": f"Already downloaded: {existing_title}"}
 
-        print(f"Sanitized title: '{title}' -> '{safe_title}'")
+        # yt-dlp writes every file under a stem derived from the URL and we rename them once the
+        # title is known from the info JSON, so the video is only extracted once per download
+        download_stem = f"ytdlp-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]}"
 
-        print(f"Downloading video: {title}")
+        print(f"Downloading video: {url}")
 
-        # Enhanced command to download video and transcript with better error handling
+        # Enhanced command to download video, metadata, thumbnail and transcript with better error handling
         cmd_download = [
             "yt-dlp",
             "--progress",
             "--no-warnings",  # Reduce noise in logs
+            "--cache-dir",
+            YTDLP_CACHE_DIR,  # Keep extractor/player caches across runs
+            "--print-to-file",  # Metadata (title, description, thumbnail URL) from the same extraction
+            _YTDLP_INFO_TEMPLATE,
+            f"{download_stem}.info.json",
+            "--write-thumbnail",  # Thumbnail from the same extraction
+            "--convert-thumbnails",
+            "jpg",  # Thumbnails are served as <title>.jpg
             "--write-auto-sub",  # Download auto-generated transcript if available
             "--write-sub",  # Download manual transcript if available
             "--sub-lang",
@@ -273,171 +745,155 @@ def download_video_and_description(url, output_path=None):
             "3",  # Retry failed downloads
             "--fragment-retries",
             "3",  # Retry failed fragments
+            "--concurrent-fragments",
+            "4",  # Fetch DASH/HLS fragments over parallel connections
             "--format",
-            "best[height<=720]/best",  # Prefer 720p or lower to avoid timeouts
+            # Prefer separate <=720p video + audio streams (H.264/AAC first for browser playback),
+            # then a pre-muxed <=720p stream, then anything
+            "bv*[height<=720][ext=mp4]+ba[ext=m4a]/bv*[height<=720]+ba/b[height<=720]/best",
+            "--merge-output-format",
+            "mp4",  # Merge separate streams into one file the player can stream
             "-o",
-            f"{safe_title}.%(ext)s",  # Use relative filename since we set working directory
+            f"{download_stem}.%(ext)s",  # Use relative filename since we set working directory
             url,
         ]
 
         print(f"Executing download command in directory '{output_path}': {' '.join(cmd_download)}")
 
         try:
-            process = subprocess.Popen(
-                cmd_download,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                cwd=output_path,  # Set working directory to output path
-            )
-
-            stderr_output = []
-            download_timeout = 1800  # 30 minutes timeout for downloads
-            start_time = time.time()
-
-            while True:
-                # Check for timeout
-                if time.time() - start_time > download_timeout:
-                    process.kill()
-                    process.wait()
-                    raise Exception(f"Download timeout - process exceeded {download_timeout} seconds")
+            returncode, stderr_output = run_download_process(cmd_download, output_path)
 
-                line = process.stdout.readline()
-                stderr_line = process.stderr.readline()
-
-                if not line and not stderr_line and process.poll() is not None:
-                    break
-
-                if line:
-                    print(line.strip())  # Log all output
-                    # Parse progress information
-                    if "%" in line:
-                        try:
-                            progress = float(line.split("%")[0].strip().split()[-1])
-                            socketio.emit("download_progress", {"progress": progress})
-                        except Exception as e:
-                            print(f"Error parsing progress: {str(e)}")
-
-                if stderr_line:
-                    stderr_output.append(stderr_line.strip())
-                    print(f"yt-dlp stderr: {stderr_line.strip()}")
-
-                    # Check for specific error patterns that indicate failure
-                    if any(
-                        error_pattern in stderr_line.lower()
-                        for error_pattern in [
-                            "error:",
-                            "unable to download",
-                            "http error",
-                            "network error",
-                            "video unavailable",
-                            "private video",
-                            "age-restricted",
-                        ]
-                    ):
-                        print(f"Detected critical error in stderr: {stderr_line.strip()}")
-
-            # Read any remaining stderr output
-            remaining_stderr = process.stderr.read()
-            if remaining_stderr:
-                stderr_output.append(remaining_stderr.strip())
-                print(f"Remaining stderr: {remaining_stderr.strip()}")
-
-            # Wait for process to complete and get final return code
-            process.wait()
-
-            if process.returncode != 0:
+            if returncode != 0:
                 error_output = "\n".join(stderr_output) if stderr_output else "Unknown download error"
-                print(f"Error downloading video (exit code {process.returncode}): {error_output}")
+                print(f"Error downloading video (exit code {returncode}): {error_output}")
 
                 # Try audio-only download as fallback
                 print("Video download failed, attempting audio-only download as fallback...")
                 try:
-                    cmd_audio_only = [
-                        "yt-dlp",
-                        "--progress",
-                        "--no-warnings",
-                        "--format",
-                        "bestaudio/best",
-                        "--extract-audio",
-                        "--audio-format",
-                        "mp3",
-                        "--audio-quality",
-                        "192K",
-                        "--retries",
-                        "3",
-                        "--fragment-retries",
-                        "3",
-                        "-o",
-                        f"{safe_title}.%(ext)s",  # Use relative filename since we set working directory
-                        url,
-                    ]
-
-                    print(f"Executing audio-only download in directory '{output_path}': {' '.join(cmd_audio_only)}")
-                    audio_result = safe_subprocess_run(
-                        cmd_audio_only, capture_output=True, text=True, timeout=600, cwd=output_path
-                    )
-
-                    if audio_result.returncode == 0:
+                    # Encode while downloading by piping yt-dlp into ffmpeg; if that fails use
+                    # yt-dlp's own download-then-convert path
+                    if pipe_audio_download(url, output_path, download_stem):
                         print("Audio-only download successful!")
-                        # Skip video processing since we only have audio
-                        downloaded_video = None
                     else:
-                        audio_error = audio_result.stderr or "Unknown audio download error"
-                        print(f"Audio-only download also failed: {audio_error}")
-                        raise Exception(
-                            f"Both video and audio-only downloads failed. Video error: "
-                            f"{error_output}. Audio error: {audio_error}"
+                        cmd_audio_only = [
+                            "yt-dlp",
+                            "--progress",
+                            "--no-warnings",
+                            "--cache-dir",
+                            YTDLP_CACHE_DIR,
+                            "--print-to-file",
+                            _YTDLP_INFO_TEMPLATE,
+                            f"{download_stem}.info.json",
+                            "--write-thumbnail",
+                            "--convert-thumbnails",
+                            "jpg",
+                            "--format",
+                            "bestaudio/best",
+                            "--extract-audio",
+                            "--audio-format",
+                            "mp3",
+                            "--audio-quality",
+                            "192K",
+                            "--retries",
+                            "3",
+                            "--fragment-retries",
+                            "3",
+                            "-o",
+                            f"{download_stem}.%(ext)s",  # Use relative filename since we set working directory
+                            url,
+                        ]
+
+                        print(f"Executing audio-only download in directory '{output_path}': {' '.join(cmd_audio_only)}")
+                        audio_result = safe_subprocess_run(
+                            cmd_audio_only, capture_output=True, text=True, timeout=600, cwd=output_path
                         )
 
+                        if audio_result.returncode == 0:
+                            print("Audio-only download successful!")
+                        else:
+                            audio_error = audio_result.stderr or "Unknown audio download error"
+                            print(f"Audio-only download also failed: {audio_error}")
+                            raise Exception(
+                                f"Both video and audio-only downloads failed. Video error: "
+                                f"{error_output}. Audio error: {audio_error}"
+                            )
+
                 except Exception as audio_e:
                     print(f"Audio-only fallback failed: {str(audio_e)}")
-                    raise Exception(f"Error downloading video (exit code {process.returncode}): {error_output}")
+                    raise Exception(f"Error downloading video (exit code {returncode}): {error_output}")
 
-        except subprocess.TimeoutExpired:
-            if "process" in locals():
-                process.kill()
-                process.wait()
-            raise Exception("Download timeout - process took too long")
         except Exception as e:
-            if "process" in locals():
-                try:
-                    process.kill()
-                    process.wait()
-                except Exception:
-                    pass
             raise Exception(f"Download process error: {str(e)}")
 
         print("Video download completed, processing files...")
 
-        # Verify download completed by checking for files
+        # Read title, description and thumbnail URL from the info JSON written alongside the download;
+        # --print-to-file appends, so after a fallback attempt the last line is the current one
+        info_json_path = os.path.join(output_path, f"{download_stem}.info.json")
+        video_info = {}
         try:
-            downloaded_files = os.listdir(output_path)
-            matching_files = [f for f in downloaded_files if f.startswith(safe_title)]
+            with open(info_json_path, "r", encoding="utf-8") as info_file:
+                info_lines = [line for line in info_file.read().splitlines() if line.strip()]
+            os.remove(info_json_path)
+            video_info = json.loads(info_lines[-1])
+        except (OSError, IndexError, json.JSONDecodeError) as e:
+            print(f"Warning: Could not read video info written by yt-dlp: {e}")
+
+        title = video_info.get("title") or download_stem
+        description = video_info.get("description") or ""
+        thumbnail_url = video_info.get("thumbnail")
 
-            if not matching_files:
-                raise Exception(f"No files found with expected prefix '{safe_title}' in {output_path}")
+        # Sanitize filename with length limits
+        safe_title = sanitize_filename(title)
 
-            print(f"Found {len(matching_files)} files with matching prefix")
+        print(f"Sanitized title: '{title}' -> '{safe_title}'")
 
+        # One directory read: rename downloaded files from the temporary stem to the sanitized
+        # title and collect every file belonging to this title for the lookups below
+        try:
+            matching_files = set()
+            with os.scandir(output_path) as it:
+                entries = list(it)
+            # Another video with the same sanitized title keeps its files; number this one instead
+            if safe_title != download_stem:
+                base_title, counter = safe_title, 1
+                while any(entry.name.startswith(f"{safe_title}.") for entry in entries):
+                    counter += 1
+                    safe_title = f"{base_title} ({counter})"
+                if safe_title != base_title:
+                    print(f"Files named '{base_title}' already exist, saving as '{safe_title}'")
+            for entry in entries:
+                file = entry.name
+                if file.startswith(f"{download_stem}.") and safe_title != download_stem:
+                    file = safe_title + file[len(download_stem) :]
+                    os.replace(entry.path, os.path.join(output_path, file))
+                # Match the full stem, so "<title> Remix.mp4" from another download is not picked up
+                if file.startswith(f"{safe_title}."):
+                    matching_files.add(file)
         except OSError as e:
             raise Exception(f"Error accessing output directory: {e}")
 
+        # Verify download completed by checking for files
+        if not matching_files:
+            raise Exception(f"No files found with expected prefix '{safe_title}' in {output_path}")
+
+        print(f"Found {len(matching_files)} files with matching prefix")
+
         # Extract audio from the downloaded video
         downloaded_video = None
-        for file in downloaded_files:
-            if file.startswith(safe_title) and any(file.endswith(ext) for ext in ALLOWED_VIDEO_EXTENSIONS):
+        for file in sorted(matching_files):
+            if any(file.endswith(ext) for ext in ALLOWED_VIDEO_EXTENSIONS):
                 downloaded_video = os.path.join(output_path, file)
                 print(f"Found downloaded video: {downloaded_video}")
                 break
 
-        if downloaded_video and os.path.exists(downloaded_video):
+        if downloaded_video:
             try:
                 print(f"Extracting audio to MP3 from video file: {downloaded_video}")
                 audio_output = os.path.join(output_path, f"{safe_title}.mp3")
 
                 # Check if MP3 already exists
-                if os.path.exists(audio_output):
+                if f"{safe_title}.mp3" in matching_files:
                     print(f"MP3 file already exists: {audio_output}")
                 else:
                     # Verify the video file is readable and has audio
@@ -470,14 +926,8 @@ def download_video_and_description(url, output_path=None):
                 f"Warning: No video file found after download. Expected file: "
                 f"{downloaded_video if downloaded_video else 'None'}"
             )
-            # List all files in the directory for debugging
-            try:
-                all_files = os.listdir(output_path)
-                print(f"Files found in output directory: {all_files}")
-                video_files = [f for f in all_files if any(f.endswith(ext) for ext in ALLOWED_VIDEO_EXTENSIONS)]
-                print(f"Video files found: {video_files}")
-            except Exception as e:
-                print(f"Error listing directory contents: {e}")
+            # List the files found for this title for debugging
+            print(f"Files found for this title: {sorted(matching_files)}")
 
         print("Saving description...")
         try:
@@ -489,17 +939,30 @@ def download_video_and_description(url, output_path=None):
             print(f"Warning: Could not save description: {e}")
             # Continue - description save failure shouldn't stop the whole process
 
-        # Download thumbnail (non-critical, continue if it fails)
-        if thumbnail_url:
+        # yt-dlp normally writes the thumbnail itself; only fetch it here if that step failed
+        # (non-critical, continue if it fails)
+        thumbnail_filename = os.path.join(output_path, f"{safe_title}.jpg")
+        if f"{safe_title}.jpg" in matching_files:
+            print(f"Thumbnail saved: {thumbnail_filename}")
+        elif thumbnail_url:
             print(f"Downloading thumbnail from: {thumbnail_url}")
-            thumbnail_filename = os.path.join(output_path, f"{safe_title}.jpg")
             try:
-                response = requests.get(thumbnail_url, stream=True, timeout=10)
-                response.raise_for_status()
-
-                with open(thumbnail_filename, "wb") as thumb_file:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        thumb_file.write(chunk)
+                # JPEGs don't compress further, so skip gzip; closing the response returns the
+                # connection to the session pool
+                with http_session.get(
+                    thumbnail_url, stream=True, timeout=10, headers={"Accept-Encoding": "identity"}
+                ) as response:
+                    response.raise_for_status()
+
+                    response.raw.decode_content = True
+                    expected_size = int(response.headers.get("Content-Length") or 0)
+                    with open(thumbnail_filename, "wb") as thumb_file:
+                        # Reserve the whole file up front so the filesystem allocates it in one go
+                        if expected_size and hasattr(os, "posix_fallocate"):
+                            os.posix_fallocate(thumb_file.fileno(), 0, expected_size)
+                        shutil.copyfileobj(response.raw, thumb_file, length=64 * 1024)
+                        # Content-Length may not match the decoded body; drop any unused reservation
+                        thumb_file.truncate()
                 print(f"Thumbnail saved: {thumbnail_filename}")
             except Exception as e:
                 print(f"Warning: Error downloading thumbnail: {str(e)}")
@@ -507,6 +970,9 @@ def download_video_and_description(url, output_path=None):
         else:
             print("Warning: No thumbnail URL available")
 
+        if os.path.exists(thumbnail_filename):
+            ensure_thumbnail_variant(thumbnail_filename)
+
         print("Creating metadata file...")
         try:
             # Store download date in a metadata file
@@ -515,15 +981,11 @@ def download_video_and_description(url, output_path=None):
 
             # Check if transcript was downloaded and add to metadata
             transcript_path = None
-            try:
-                current_files = os.listdir(output_path)
-                for file in current_files:
-                    if file.startswith(safe_title) and file.endswith(".srt"):
-                        transcript_path = os.path.join(output_path, file)
-                        print(f"Found transcript: {transcript_path}")
-                        break
-            except Exception as e:
-                print(f"Warning: Error checking for transcript files: {e}")
+            for file in sorted(matching_files):
+                if file.endswith(".srt"):
+                    transcript_path = os.path.join(output_path, file)
+                    print(f"Found transcript: {transcript_path}")
+                    break
 
             metadata = {
                 "download_date": download_date,
@@ -622,69 +1084,120 @@ def download_page():
         success, error_msg = validate_and_create_directory(user_dir)
         if not success:
             return jsonify({"success": False, "message": f"Directory error: {error_msg}"})
+        # Long-running; run it in the download pool and let the client poll for the result
         if source == "youtube":
-            result = download_video_and_description(url, output_path=user_dir)
+            job_id = submit_download_job(download_video_and_description, url, output_path=user_dir)
         elif source == "soundcloud":
-            result = download_soundcloud_track(url, output_path=user_dir)
+            job_id = submit_download_job(download_soundcloud_track, url, output_path=user_dir)
         else:
-            result = {"success": False, "message": "Invalid source selected"}
-        return jsonify(result)
+            return jsonify({"success": False, "message": "Invalid source selected"})
+        return jsonify({"success": True, "job_id": job_id, "message": "Download started"})
     return render_template("download.html")
 
 
-@app.route("/media")
-def list_media():
-    """List all media files in the user's media directory."""
-    user, user_dir = get_user_from_request()
-    media_files = []
-    sort_by = request.args.get("sort", "date_downloaded")  # Default sort by date downloaded
-    sort_order = request.args.get("order", "desc")  # Default descending order
+@app.route("/download/status/<job_id>")
+def download_status(job_id):
+    """Report whether a queued download has finished, and its result once it has."""
+    future = download_jobs.get(job_id)
+    if future is None:
+        return jsonify({"success": False, "status": "unknown", "message": "Unknown download job"}), 404
+    if not future.done():
+        return jsonify({"success": True, "status": "running", "message": "Download in progress"})
+
+    download_jobs.pop(job_id, None)
+    download_job_finish_times.pop(job_id, None)
+    try:
+        result = future.result()
+    except Exception as e:
+        result = {"success": False, "message": f"Download failed: {str(e)}"}
+    return jsonify({**result, "status": "done"})
+
+
+def scan_media_directories(path):
+    """
+    Walk a media directory tree with os.scandir, one directory read per level.
+
+    Args:
+        path (str): Directory to scan
+
+    Yields:
+        tuple: (directory: str, entries: dict of name -> os.DirEntry)
+    """
+    with os.scandir(path) as it:
+        entries = {entry.name: entry for entry in it}
+    yield path, entries
+    for entry in entries.values():
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_media_directories(entry.path)
+
+
+@functools.lru_cache(maxsize=4096)
+def load_media_metadata(meta_path, mtime_ns):
+    """
+    Read a .meta sidecar file, cached per path and modification time.
+
+    Args:
+        meta_path (str): Path to the .meta file
+        mtime_ns (int): Modification time of the file, so a rewritten file is read again
+
+    Returns:
+        dict: Parsed metadata, shared between callers and not to be modified
+    """
+    with open(meta_path, "r", encoding="utf-8") as meta_file:
+        return json.load(meta_file)
+
+
+def collect_media_files(user_dir):
+    """
+    Scan a user's media directory and describe every audio/video file in it.
 
-    for root, dirs, files in os.walk(user_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            _, extension = os.path.splitext(file)
+    Args:
+        user_dir (str): User media directory
 
-            if extension.lower() in ALLOWED_AUDIO_EXTENSIONS or extension.lower() in ALLOWED_VIDEO_EXTENSIONS:
+    Returns:
+        list: Media file dicts, with "size" in MB as a float for sorting
+    """
+    media_files = []
+    for root, entries in scan_media_directories(user_dir):
+        for file, entry in entries.items():
+            if not entry.is_file():
+                continue
+            file_path = entry.path
+            filename_without_ext, extension = os.path.splitext(file)
+            extension = extension.lower()
+
+            if extension in ALLOWED_AUDIO_EXTENSIONS or extension in ALLOWED_VIDEO_EXTENSIONS:
                 rel_path = os.path.relpath(file_path, user_dir)
-                filename_without_ext = os.path.splitext(file)[0]
 
-                media_type = "audio" if extension.lower() in ALLOWED_AUDIO_EXTENSIONS else "video"
+                media_type = "audio" if extension in ALLOWED_AUDIO_EXTENSIONS else "video"
 
-                stats = os.stat(file_path)
+                stats = entry.stat()
                 size_mb = stats.st_size / (1024 * 1024)
                 date_modified = stats.st_mtime  # Get modification time
 
                 # Try to get download date from metadata file
-                metadata_path = os.path.join(root, f"{filename_without_ext}.meta")
+                metadata_name = f"{filename_without_ext}.meta"
                 date_downloaded = date_modified  # Default to modification date if no metadata
-                if os.path.exists(metadata_path):
+                if metadata_name in entries:
                     try:
-                        with open(metadata_path, "r") as meta_file:
-                            metadata = json.load(meta_file)
-                            date_downloaded = metadata.get("download_date", date_modified)
+                        meta_entry = entries[metadata_name]
+                        metadata = load_media_metadata(meta_entry.path, meta_entry.stat().st_mtime_ns)
+                        date_downloaded = metadata.get("download_date", date_modified)
                     except Exception:
                         pass
 
                 # Look for matching thumbnail in the same directory
-                thumbnail_found = False
-                for img_ext in ALLOWED_IMAGE_EXTENSIONS:
-                    potential_thumbnail = os.path.join(root, filename_without_ext + img_ext)
-                    if os.path.exists(potential_thumbnail):
-                        thumbnail_rel_path = os.path.relpath(potential_thumbnail, user_dir)
-                        thumbnail_found = True
-                        break
-
-                # If no matching thumbnail found, use default
-                if not thumbnail_found:
-                    if media_type == "audio":
-                        thumbnail_rel_path = "default_audio_thumbnail.jpg"
-                    else:
-                        thumbnail_rel_path = "default_video_thumbnail.jpg"
-
-                # Fix thumbnail path for display
-                if not thumbnail_rel_path.startswith(PREFIX):
-                    thumbnail_rel_path = thumbnail_rel_path
+                img_ext = next(
+                    (ext for ext in ALLOWED_IMAGE_EXTENSIONS if filename_without_ext + ext in entries),
+                    None,
+                )
+                if img_ext:
+                    thumbnail_rel_path = os.path.relpath(entries[filename_without_ext + img_ext].path, user_dir)
+                elif media_type == "audio":
+                    # If no matching thumbnail found, use default
+                    thumbnail_rel_path = "default_audio_thumbnail.jpg"
+                else:
+                    thumbnail_rel_path = "default_video_thumbnail.jpg"
 
                 media_files.append(
                     {
@@ -693,73 +1206,213 @@ def list_media():
                         "path": rel_path,
                         "type": media_type,
                         "size": size_mb,  # Store as float for sorting
-                        "size_display": f"{size_mb:.2f} MB",
                         "date_modified": date_modified,
                         "date_downloaded": date_downloaded,
                         "thumbnail": thumbnail_rel_path,
                     }
                 )
 
-    # Sort the media files based on the specified criteria
-    reverse = sort_order == "desc"
-    if sort_by == "name":
-        media_files.sort(key=lambda x: x["name"].lower(), reverse=reverse)
-    elif sort_by == "date":
-        media_files.sort(key=lambda x: x["date_modified"], reverse=reverse)
-    elif sort_by == "date_downloaded":
-        media_files.sort(key=lambda x: x["date_downloaded"], reverse=reverse)
-    elif sort_by == "size":
-        media_files.sort(key=lambda x: x["size"], reverse=reverse)
+    return media_files
 
-    # Convert size back to string for display
-    for file in media_files:
-        file["size"] = file["size_display"]
-        del file["size_display"]
 
-    return jsonify(media_files)
+def open_media_index():
+    """
+    Open the SQLite media index, creating its tables if needed.
 
+    Returns:
+        sqlite3.Connection: Connection returning sqlite3.Row rows
+    """
+    connection = sqlite3.connect(os.path.join(MEDIA_FOLDER, MEDIA_INDEX_FILENAME), timeout=10)
+    connection.row_factory = sqlite3.Row
+    # The index only holds data derived from the media folders, so an outdated schema is rebuilt
+    if connection.execute("PRAGMA user_version").fetchone()[0] != _MEDIA_INDEX_VERSION:
+        connection.executescript(
+            "DROP TABLE IF EXISTS media;\nDROP TABLE IF EXISTS media_dirs;\n"
+            f"{_MEDIA_INDEX_SCHEMA}PRAGMA user_version = {_MEDIA_INDEX_VERSION};"
+        )
+    return connection
+
+
+def media_tree_signature(user_dir):
+    """
+    Fingerprint a media directory tree by the mtimes of every directory in it.
 
-@app.route("/stream/<path:filename>")
-def stream_file(filename):
-    """Stream a media file."""
-    user, user_dir = get_user_from_request()
-    file_path = os.path.join(user_dir, filename)
+    Adding, removing or renaming a file bumps the mtime of the directory holding it, so the
+    signature changes whenever files change at any depth of the tree.
 
-    if not os.path.exists(file_path):
-        return "File not found", 404
+    Args:
+        user_dir (str): User media directory
 
-    file_size = os.path.getsize(file_path)
+    Returns:
+        tuple: (signature: str, newest_mtime_ns: int)
+    """
+    digest = hashlib.sha1()
+    newest_mtime_ns = 0
+    pending = [user_dir]
+    while pending:
+        path = pending.pop()
+        mtime_ns = os.stat(path).st_mtime_ns
+        newest_mtime_ns = max(newest_mtime_ns, mtime_ns)
+        digest.update(f"{os.path.relpath(path, user_dir)}\0{mtime_ns}\0".encode("utf-8", "surrogateescape"))
+        # Same traversal as scan_media_directories (symlinked directories are not followed)
+        with os.scandir(path) as it:
+            pending.extend(sorted(entry.path for entry in it if entry.is_dir(follow_symlinks=False)))
+    return digest.hexdigest(), newest_mtime_ns
+
+
+def sync_media_index(connection, user, user_dir):
+    """
+    Re-scan a user's media directory into the index if it changed since the last scan.
 
-    range_header = request.headers.get("Range", None)
+    Downloads and deletes add, remove or rename files, which bumps the mtime of the
+    directory holding them, so an unchanged media_tree_signature means the indexed rows
+    are current.
 
-    if range_header:
-        byte_start, byte_end = 0, None
-        if range_header:
-            ranges = range_header.strip().replace("bytes=", "").split("-")
-            if ranges[0]:
-                byte_start = int(ranges[0])
-            if ranges[1]:
-                byte_end = int(ranges[1])
+    Args:
+        connection (sqlite3.Connection): Open media index
+        user (str): Normalized username
+        user_dir (str): User media directory
+    """
+    signature, newest_mtime_ns = media_tree_signature(user_dir)
+    row = connection.execute("SELECT signature FROM media_dirs WHERE user = ?", (user,)).fetchone()
+    if row is not None and row["signature"] == signature:
+        return
 
-        if byte_end is None:
-            byte_end = file_size - 1
+    media_files = collect_media_files(user_dir)
+    # Don't trust a directory modified within the last second; a change landing in the
+    # same mtime tick would otherwise go unnoticed, so force a re-scan next time
+    recorded_signature = signature if time.time_ns() - newest_mtime_ns > 1_000_000_000 else None
+    with connection:
+        connection.execute("DELETE FROM media WHERE user = ?", (user,))
+        connection.executemany(
+            "INSERT INTO media (user, rel_path, name, type, size, date_modified, date_downloaded, thumbnail) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    user,
+                    media_file["path"],
+                    media_file["name"],
+                    media_file["type"],
+                    media_file["size"],
+                    media_file["date_modified"],
+                    media_file["date_downloaded"],
+                    media_file["thumbnail"],
+                )
+                for media_file in media_files
+            ],
+        )
+        connection.execute(
+            "INSERT INTO media_dirs (user, signature) VALUES (?, ?) "
+            "ON CONFLICT (user) DO UPDATE SET signature = excluded.signature",
+            (user, recorded_signature),
+        )
+
+
+def reconcile_media_index():
+    """Bring the media index in line with every user directory in MEDIA_FOLDER."""
+    try:
+        with contextlib.closing(open_media_index()) as connection:
+            users = []
+            with os.scandir(MEDIA_FOLDER) as it:
+                for entry in it:
+                    # Usernames never start with a dot (see sanitize_filename), so hidden directories
+                    # such as the yt-dlp cache are not user libraries
+                    if entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+                        users.append(entry.name)
+                        sync_media_index(connection, entry.name, entry.path)
+            # Drop rows of users whose directory no longer exists
+            placeholders = ", ".join("?" for _ in users)
+            with connection:
+                connection.execute(f"DELETE FROM media WHERE user NOT IN ({placeholders})", users)
+                connection.execute(f"DELETE FROM media_dirs WHERE user NOT IN ({placeholders})", users)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: Could not reconcile media index: {e}")
 
-        content_length = byte_end - byte_start + 1
 
-        headers = {
-            "Content-Range": f"bytes {byte_start}-{byte_end}/{file_size}",
-            "Accept-Ranges": "bytes",
-            "Content-Length": content_length,
-            "Content-Type": mimetypes.guess_type(file_path)[0],
+@app.route("/media")
+def list_media():
+    """List all media files in the user's media directory."""
+    user, user_dir = get_user_from_request()
+    sort_by = request.args.get("sort", "date_downloaded")  # Default sort by date downloaded
+    sort_order = request.args.get("order", "desc")  # Default descending order
+
+    # Sort the media files based on the specified criteria (scan order if the criteria is unknown)
+    column = _MEDIA_SORT_COLUMNS.get(sort_by)
+    if column:
+        order_by = f"{column} {'DESC' if sort_order == 'desc' else 'ASC'}"
+    else:
+        order_by = "rowid"
+
+    with contextlib.closing(open_media_index()) as connection:
+        sync_media_index(connection, user, user_dir)
+        rows = connection.execute(
+            "SELECT rel_path, name, type, size, date_modified, date_downloaded, thumbnail "
+            f"FROM media WHERE user = ? ORDER BY {order_by}",
+            (user,),
+        ).fetchall()
+
+    media_files = [
+        {
+            "id": row["rel_path"],
+            "name": row["name"],
+            "path": row["rel_path"],
+            "type": row["type"],
+            "size": f"{row['size']:.2f} MB",
+            "date_modified": row["date_modified"],
+            "date_downloaded": row["date_downloaded"],
+            "thumbnail": row["thumbnail"],
         }
+        for row in rows
+    ]
+    response = jsonify(media_files)
+    # The listing changes right after downloads and deletes, so browsers revalidate every time and get
+    # a 304 while the ETag (a hash of the listing itself) still matches
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@functools.lru_cache(maxsize=64)
+def mime_for_extension(ext):
+    """
+    Look up the mimetype for a file extension.
+
+    Args:
+        ext (str): Lower-cased extension including the dot (e.g. ".mp3")
 
-        with open(file_path, "rb") as f:
-            f.seek(byte_start)
-            data = f.read(content_length)
+    Returns:
+        str: Mimetype, application/octet-stream if unknown
+    """
+    return mimetypes.guess_type("x" + ext)[0] or "application/octet-stream"
 
-        return Response(data, 206, headers)
-    else:
-        return send_from_directory(user_dir, filename)
+
+def guess_mime(path):
+    """
+    Guess the mimetype of a file from its extension.
+
+    Args:
+        path (str): File path or name
+
+    Returns:
+        str: Mimetype, application/octet-stream if unknown
+    """
+    return mime_for_extension(os.path.splitext(path)[1].lower())
+
+
+@app.route("/stream/<path:filename>")
+def stream_file(filename):
+    """Stream a media file."""
+    user, user_dir = get_user_from_request()
+    file_path = os.path.join(user_dir, filename)
+
+    if not os.path.exists(file_path):
+        return "File not found", 404
+
+    # Werkzeug answers Range requests with 206 from the open file (no full read into memory),
+    # revalidates with ETag/Last-Modified and hands the file to wsgi.file_wrapper, which lets the
+    # server use sendfile where available (or only sets X-Sendfile when USE_X_SENDFILE is enabled)
+    return send_from_directory(user_dir, filename, mimetype=guess_mime(file_path), conditional=True)
 
 
 @app.route("/thumbnail/<path:filename>")
@@ -767,19 +1420,48 @@ def serve_thumbnail(filename):
     """Serve thumbnail images from the user's media folder or default thumbnails."""
     user, user_dir = get_user_from_request()
 
-    # Check if file exists in user directory first
-    user_file_path = os.path.join(user_dir, filename)
+    # Check if file exists in user directory first; safe_join rejects paths leaving it, before
+    # anything is opened or written next to the file
+    user_file_path = safe_join(user_dir, filename)
+    if user_file_path is None:
+        abort(404)
     if os.path.exists(user_file_path):
-        return send_from_directory(user_dir, filename)
-
+        # Prefer the small WebP copy of downloaded thumbnails, generating it on first request
+        variant_path = None
+        if os.path.splitext(filename)[1].lower() in (".jpg", ".jpeg", ".png"):
+            variant_path = ensure_thumbnail_variant(user_file_path)
+        if variant_path:
+            response = send_from_directory(user_dir, os.path.relpath(variant_path, user_dir))
+        else:
+            response = send_from_directory(user_dir, filename)
     # If not found in user directory, check for default thumbnails in main downloads folder
-    if filename in ["default_audio_thumbnail.jpg", "default_video_thumbnail.jpg"]:
-        default_file_path = os.path.join(MEDIA_FOLDER, filename)
-        if os.path.exists(default_file_path):
-            return send_from_directory(MEDIA_FOLDER, filename)
+    elif filename in DEFAULT_THUMBNAILS and os.path.exists(os.path.join(MEDIA_FOLDER, filename)):
+        response = send_from_directory(MEDIA_FOLDER, filename)
+    else:
+        # If file not found anywhere, return 404
+        abort(404)
 
-    # If file not found anywhere, return 404
-    abort(404)
+    # Thumbnails only change when a download is replaced, so let browsers keep them for a day
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+
+@app.after_request
+def use_x_accel_redirect(response):
+    """Hand files offloaded with X-Sendfile to Nginx through X-Accel-Redirect when X_ACCEL_PREFIX is set."""
+    sendfile_path = response.headers.get("X-Sendfile")
+    if not X_ACCEL_PREFIX or not sendfile_path:
+        return response
+
+    # Media (downloads/) and templates/ both live under the app directory that the internal location aliases
+    relative_path = os.path.relpath(sendfile_path, app.root_path)
+    if relative_path.startswith(os.pardir):
+        return response
+
+    del response.headers["X-Sendfile"]
+    response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX.rstrip("/") + "/" + quote(relative_path.replace(os.sep, "/"))
+    return response
 
 
 @app.route("/templates/<path:filename>")
@@ -795,15 +1477,15 @@ def serve_description(filename):
     base_name = os.path.splitext(filename)[0]
     description_path = os.path.join(user_dir, f"{base_name}.txt")
 
-    if os.path.exists(description_path):
-        try:
-            with open(description_path, "r", encoding="utf-8") as f:
-                description = f.read()
-            return jsonify({"success": True, "description": description})
-        except Exception as e:
-            return jsonify({"success": False, "message": str(e)})
-    else:
-        return jsonify({"success": False, "message": "Description file not found"})
+    if not os.path.exists(description_path):
+        return "Description file not found", 404
+
+    # Sent as the plain file, so Werkzeug adds ETag/Last-Modified and answers repeat views with a 304
+    response = send_from_directory(user_dir, f"{base_name}.txt", mimetype="text/plain; charset=utf-8")
+    # A re-download rewrites the file in place, so revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/delete", methods=["POST"])
@@ -826,23 +1508,26 @@ def delete_files():
         deleted_files = []
         errors = []
         for file_path in files:
-            try:
-                base_name = os.path.splitext(file_path)[0]
-                media_path = os.path.join(user_dir, file_path)
-                if os.path.exists(media_path):
-                    os.remove(media_path)
+            base_name = os.path.splitext(file_path)[0]
+            # Remove directly instead of checking exists() first; a missing file is not an error
+            for path in (
+                file_path,
+                f"{base_name}.txt",
+                f"{base_name}.jpg",
+                f"{base_name}.meta",
+                f"{base_name}.jpg{THUMBNAIL_VARIANT_SUFFIX}",
+            ):
+                try:
+                    os.remove(os.path.join(user_dir, path))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    errors.append(f"Error deleting {path}: {str(e)}")
+                    if path == file_path:
+                        break  # Keep the sidecar files of media that is still there
+                    continue
+                if path == file_path:
                     deleted_files.append(file_path)
-                associated_files = [
-                    f"{base_name}.txt",
-                    f"{base_name}.jpg",
-                    f"{base_name}.meta",
-                ]
-                for assoc_file in associated_files:
-                    assoc_path = os.path.join(user_dir, assoc_file)
-                    if os.path.exists(assoc_path):
-                        os.remove(assoc_path)
-            except Exception as e:
-                errors.append(f"Error deleting {file_path}: {str(e)}")
         if errors:
             return jsonify(
                 {
@@ -866,68 +1551,88 @@ def delete_files():
 
 # Create default thumbnails
 def create_default_thumbnails():
-    """Create default thumbnail images if they don't exist."""
-    try:
-        from PIL import Image
-
-        default_audio_path = os.path.join(MEDIA_FOLDER, "default_audio_thumbnail.jpg")
-        default_video_path = os.path.join(MEDIA_FOLDER, "default_video_thumbnail.jpg")
-
-        if not os.path.exists(default_audio_path):
-            img = Image.new("RGB", (200, 200), color=(73, 109, 137))
-            img.save(default_audio_path)
-
-        if not os.path.exists(default_video_path):
-            img = Image.new("RGB", (200, 200), color=(120, 80, 100))
-            img.save(default_video_path)
-    except ImportError:
-        print("PIL not installed. Default thumbnails will not be created.")
-        print("Please install Pillow with: pip install Pillow")
-        return
-
+    """Copy the bundled default thumbnail images into the media folder if they don't exist."""
+    for filename in DEFAULT_THUMBNAILS:
+        target_path = os.path.join(MEDIA_FOLDER, filename)
+        if os.path.exists(target_path):
+            continue
+        try:
+            shutil.copyfile(os.path.join(DEFAULT_THUMBNAIL_ASSETS, filename), target_path)
+        except OSError as e:
+            print(f"Warning: Could not create default thumbnail {target_path}: {e}")
 
-@app.route("/search", methods=["POST"])
-def search_youtube():
-    """Search YouTube for videos."""
-    if ytsearch is None:
-        return jsonify({"success": False, "message": "youtube_dl is not installed"})
 
-    query = request.form.get("query")
-    max_results = 50  # int(request.form.get('max_results', 50))
+def cached_youtube_search(query, max_results=50):
+    """
+    Search YouTube, reusing results for the same query for SEARCH_CACHE_TTL seconds.
 
-    if not query:
-        return jsonify({"success": False, "message": "No search query provided"})
+    Args:
+        query (str): Search term
+        max_results (int): Maximum number of results (default: 50)
 
-    try:
-        yts = ytsearch.YTSearch()
-        search_results = yts.search_by_term(term=query, max_results=max_results)
+    Returns:
+        list: Result dicts formatted for the frontend
+    """
+    global _last_search_time
+
+    key = query.strip().lower()
+    cached = _search_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    with _search_lock:
+        # Another request may have fetched the same query while this one waited
+        cached = _search_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        wait = _last_search_time + SEARCH_MIN_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            search_results = ytsearch.YTSearch().search_by_term(term=query, max_results=max_results)
+        finally:
+            _last_search_time = time.monotonic()
 
         # Format results for frontend
         formatted_results = []
         for result in search_results:
             video_id = result.get("id")
-            # Try hq720 first, fall back to hqdefault if not available
-            thumbnail_url = f"https://i.ytimg.com/vi/{video_id}/hq720.jpg" if video_id else None
-            if thumbnail_url:
-                try:
-                    response = requests.head(thumbnail_url)
-                    if response.status_code != 200:
-                        thumbnail_url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
-                except Exception:
-                    thumbnail_url = f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg"
-
             formatted_results.append(
                 {
                     "id": video_id,
                     "title": result.get("title"),
                     "url": f"https://www.youtube.com/watch?v={video_id}",
-                    "thumbnail": thumbnail_url,
+                    # hq720 is not generated for every video; the browser switches to the fallback if it is missing
+                    "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hq720.jpg" if video_id else None,
+                    "thumbnail_fallback": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg" if video_id else None,
                     "duration": result.get("duration", ""),
                     "views": result.get("views", ""),
                 }
             )
 
-        return jsonify({"success": True, "results": formatted_results})
+        # Drop the oldest entry (dicts keep insertion order) once the cache is full
+        _search_cache.pop(key, None)
+        if len(_search_cache) >= SEARCH_CACHE_SIZE:
+            _search_cache.pop(next(iter(_search_cache)))
+        _search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL, formatted_results)
+        return formatted_results
+
+
+@app.route("/search", methods=["POST"])
+def search_youtube():
+    """Search YouTube for videos."""
+    if ytsearch is None:
+        return jsonify({"success": False, "message": "youtube_dl is not installed"})
+
+    query = request.form.get("query")
+    max_results = 50  # int(request.form.get('max_results', 50))
+
+    if not query:
+        return jsonify({"success": False, "message": "No search query provided"})
+
+    try:
+        return jsonify({"success": True, "results": cached_youtube_search(query, max_results)})
     except Exception as e:
         print(f"Search error: {str(e)}")  # Add debug logging
         return jsonify({"success": False, "message": f"Error searching YouTube: {str(e)}"})
@@ -951,4 +1656,5 @@ def get_user_from_request():
 
 if __name__ == "__main__":
     create_default_thumbnails()
+    reconcile_media_index()
     socketio.run(app, host="0.0.0.0", port=5000, debug=True)